@@ -0,0 +1,289 @@
+"""Load test offline untuk bot.py pakai fake Bot API server lokal.
+
+    python bench.py --users 2000 --updates 3000 --concurrency 100 --api-latency-ms 15
+
+Bot diarahkan ke fake server (aiohttp) lewat BOT_API_URL dan pakai DB sementara
+lewat DB_PATH. Update sintetis dimasukkan ke `dp` asli lewat dp.feed_update, jadi
+yang diukur handler beneran: /start <code>, cek fsub, TOP 5 WEEKLY, broadcast,
+join referral dan urutan FSM per user lewat executor. Hasilnya latency p50/p99 per skenario, throughput, waktu DB dan
+jumlah call Bot API per method.
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter
+
+from aiohttp import web
+
+OWNER_ID = 1
+BENCH_TOKEN = "123456:BENCHBENCHBENCHBENCHBENCHBENCHBENCH"
+FSUB_CHANNELS = "@bench_ch1 @bench_ch2 @bench_ch3 @bench_ch4"
+
+# ================= FAKE BOT API =================
+class FakeBotAPI:
+    """Stand-in Bot API: balas semua method dengan payload minimal yang valid."""
+
+    def __init__(self, latency_ms: float):
+        self.latency = latency_ms / 1000
+        self.calls = Counter()
+        self.message_id = 0
+
+    def _message(self, chat_id, text=None):
+        self.message_id += 1
+        chat_id = int(chat_id) if str(chat_id).lstrip("-").isdigit() else -1001
+        return {"message_id": self.message_id, "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "channel"},
+                "text": text or ""}
+
+    async def handle(self, request: web.Request):
+        method = request.match_info["method"]
+        self.calls[method] += 1
+        data = await request.post()
+        if self.latency: await asyncio.sleep(self.latency)
+
+        name = method.lower()
+        if name == "getme":
+            result = {"id": 123456, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        elif name == "getchatmember":
+            result = {"status": "member",
+                      "user": {"id": int(data.get("user_id", 0)), "is_bot": False, "first_name": "u"}}
+        elif name == "copymessage":
+            self.message_id += 1
+            result = {"message_id": self.message_id}
+        elif name == "createchatinvitelink":
+            self.message_id += 1
+            result = {"invite_link": f"https://t.me/+bench{self.message_id}", "is_primary": False,
+                      "is_revoked": False, "creates_join_request": False,
+                      "creator": {"id": 123456, "is_bot": True, "first_name": "Bench"}}
+        elif name.startswith("send") and name != "sendchataction" or name.startswith("edit") or name == "forwardmessage":
+            result = self._message(data.get("chat_id", 0), data.get("text"))
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def start(self, port: int):
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, "127.0.0.1", port).start()
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+# ================= UPDATE SINTETIS =================
+_update_id = 0
+
+def _next_id():
+    global _update_id
+    _update_id += 1
+    return _update_id
+
+def _user(uid):
+    return {"id": uid, "is_bot": False, "first_name": f"u{uid}"}
+
+def message_update(uid, text):
+    return {"update_id": _next_id(), "message": {
+        "message_id": _next_id(), "date": int(time.time()), "chat": {"id": uid, "type": "private"},
+        "from": _user(uid), "text": text}}
+
+def callback_update(uid, data):
+    return {"update_id": _next_id(), "callback_query": {
+        "id": str(_next_id()), "from": _user(uid), "chat_instance": "bench", "data": data,
+        "message": {"message_id": _next_id(), "date": int(time.time()),
+                    "chat": {"id": uid, "type": "private"}, "text": "menu"}}}
+
+def join_update(uid, inviter):
+    member = lambda status: {"status": status, "user": _user(uid)}
+    return {"update_id": _next_id(), "chat_member": {
+        "chat": {"id": -1002, "type": "channel", "username": "bench_ref"}, "from": _user(uid),
+        "date": int(time.time()), "old_chat_member": member("left"), "new_chat_member": member("member"),
+        "invite_link": {"invite_link": "https://t.me/+ref", "name": f"REF_{inviter}", "is_primary": False,
+                        "is_revoked": False, "creates_join_request": False,
+                        "creator": {"id": 123456, "is_bot": True, "first_name": "Bench"}}}}
+
+# ================= PENGUKURAN =================
+class DBTimer:
+    """Total waktu & jumlah query dari histogram `db` milik bot (InstrumentedDatabase).
+    Ikut ngitung database.transaction(...) (label `[tx] ...`, satu transaksi = satu query)."""
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    def snapshot(self):
+        hists = self.metrics.histograms["db"].values()
+        return sum(h.total for h in hists), sum(h.count for h in hists)
+
+def percentile(values, pct):
+    if not values: return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+async def replay(bot_module, updates, concurrency):
+    """Feed semua update ke dp dengan `concurrency` update paralel. Return latency & error."""
+    from aiogram.types import Update
+    sem = asyncio.Semaphore(concurrency)
+    latencies, errors = [], 0
+
+    async def one(raw):
+        nonlocal errors
+        async with sem:
+            update = Update.model_validate(raw, context={"bot": bot_module.bot})
+            started = time.perf_counter()
+            try:
+                await bot_module.dp.feed_update(bot_module.bot, update)
+            except Exception:
+                errors += 1
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(u) for u in updates))
+    return latencies, errors, time.perf_counter() - started
+
+async def run_scenario(name, bot_module, api, db_timer, updates, concurrency, results):
+    calls_before = Counter(api.calls)
+    db_before = db_timer.snapshot()
+    latencies, errors, elapsed = await replay(bot_module, updates, concurrency)
+    await bot_module.update_executor.wait_idle()  # UPDATE_WORKERS>0: feed_update cuma ngantre
+    await bot_module.view_buffer.flush()
+    db_after = db_timer.snapshot()
+    results.append({
+        "scenario": name, "updates": len(updates), "errors": errors,
+        "p50_ms": percentile(latencies, 50) * 1000, "p99_ms": percentile(latencies, 99) * 1000,
+        "throughput": len(updates) / elapsed if elapsed else 0,
+        "db_ms": (db_after[0] - db_before[0]) * 1000, "db_queries": db_after[1] - db_before[1],
+        "api_calls": dict(Counter(api.calls) - calls_before),
+    })
+
+async def seed(database, users, media):
+    """Isi DB sementara dengan user & media sintetis."""
+    async with database.transaction() as db:
+        await db.executemany("INSERT OR IGNORE INTO users (user_id) VALUES (?)",
+                             [(1000 + i,) for i in range(users)])
+        await db.executemany("INSERT OR IGNORE INTO media (code, file_id, type, caption, title) VALUES (?, ?, ?, ?, ?)",
+                             [(f"code{i:05d}", f"FILE{i}", "video" if i % 2 else "photo", "bench", f"Title {i}")
+                              for i in range(media)])
+
+# ================= MAIN =================
+async def main(args):
+    api = FakeBotAPI(args.api_latency_ms)
+    await api.start(args.port)
+
+    tmpdir = tempfile.mkdtemp(prefix="botbench-")
+    os.environ.update({
+        "BOT_TOKEN": BENCH_TOKEN, "ADMIN_ID": str(OWNER_ID),
+        "BOT_API_URL": f"http://127.0.0.1:{args.port}", "DB_PATH": os.path.join(tmpdir, "bench.db"),
+        # Handler dijalankan inline biar latency feed_update = latency handler
+        "UPDATE_WORKERS": os.environ.get("UPDATE_WORKERS", "0"),
+    })
+    if not args.real_limits:
+        # Yang diukur bot-nya, bukan rate limiter Telegram
+        os.environ.update({"API_GLOBAL_RATE": "1000000", "API_PRIVATE_RATE": "1000000",
+                           "CHANNEL_RATE_PER_MIN": "1000000", "BROADCAST_RATE": "1000000"})
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import bot as bot_module
+
+    await bot_module.database.open()
+    await bot_module.migrate()
+    await seed(bot_module.database, args.users, args.media)
+    await bot_module.database.close()
+    await bot_module.startup()
+    db_timer = DBTimer(bot_module.metrics)
+
+    rng = random.Random(42)
+    codes = [f"code{i:05d}" for i in range(args.media)]
+    hot_codes = codes[:5]  # beberapa post lagi viral
+    user_ids = [1000 + i for i in range(args.users)]
+    scenarios = set(args.scenarios.split(","))
+    results = []
+
+    try:
+        if "start" in scenarios:
+            updates = []
+            for _ in range(args.updates):
+                roll = rng.random()
+                code = rng.choice(hot_codes) if roll < 0.8 else (rng.choice(codes) if roll < 0.95 else f"junk{rng.randrange(10**6)}")
+                updates.append(message_update(rng.choice(user_ids), f"/start {code}"))
+            await run_scenario("start_deeplink", bot_module, api, db_timer, updates, args.concurrency, results)
+
+        if "fsub" in scenarios:
+            await bot_module.set_config("fsub_channels", FSUB_CHANNELS)
+            updates = [message_update(rng.choice(user_ids), f"/start {rng.choice(hot_codes)}")
+                       for _ in range(args.updates)]
+            await run_scenario("start_fsub", bot_module, api, db_timer, updates, args.concurrency, results)
+            await bot_module.set_config("fsub_channels", "")
+
+        if "top" in scenarios:
+            updates = [callback_update(rng.choice(user_ids), "top_weekly") for _ in range(args.updates)]
+            await run_scenario("top_weekly", bot_module, api, db_timer, updates, args.concurrency, results)
+
+        if "referral" in scenarios:
+            inviters = user_ids[:20]
+            updates = [join_update(900000 + i, rng.choice(inviters)) for i in range(args.updates)]
+            await run_scenario("referral_join", bot_module, api, db_timer, updates, args.concurrency, results)
+
+        if "fsm" in scenarios:
+            # Dua update beruntun dari user yang sama lewat executor, urutannya kayak polling:
+            # tombol ASK (set state) lalu langsung pesannya. Pesan harus lihat state yang baru.
+            executor = bot_module.update_executor
+            saved = executor.enabled, executor.sem
+            executor.enabled, executor.sem = True, asyncio.Semaphore(32)
+            askers = rng.sample(user_ids, min(args.updates // 2, len(user_ids)))
+            updates = []
+            for uid in askers:
+                updates += [callback_update(uid, "menu_ask"), message_update(uid, "halo admin")]
+            try:
+                await run_scenario("fsm_pair", bot_module, api, db_timer, updates, 1, results)
+            finally:
+                executor.enabled, executor.sem = saved
+            stuck = 0
+            for uid in askers:
+                state = bot_module.dp.fsm.get_context(bot_module.bot, chat_id=uid, user_id=uid)
+                if await state.get_state() is not None: stuck += 1
+            results[-1]["errors"] += stuck  # pesan yang nyasar = state ketinggalan
+
+        if "broadcast" in scenarios:
+            state = bot_module.dp.fsm.get_context(bot_module.bot, chat_id=OWNER_ID, user_id=OWNER_ID)
+            await state.set_state(bot_module.AdminStates.waiting_for_broadcast)
+            calls_before = Counter(api.calls)
+            started = time.perf_counter()
+            db_before = db_timer.snapshot()
+            await run_scenario("broadcast_cmd", bot_module, api, db_timer,
+                               [message_update(OWNER_ID, "hello semua")], 1, results)
+            await asyncio.gather(*bot_module.broadcast_engine.tasks.values())
+            elapsed = time.perf_counter() - started
+            db_after = db_timer.snapshot()
+            sent = (Counter(api.calls) - calls_before)["copyMessage"]
+            results.append({"scenario": "broadcast_job", "updates": sent, "errors": 0, "p50_ms": 0, "p99_ms": 0,
+                            "throughput": sent / elapsed if elapsed else 0,
+                            "db_ms": (db_after[0] - db_before[0]) * 1000, "db_queries": db_after[1] - db_before[1],
+                            "api_calls": dict(Counter(api.calls) - calls_before)})
+    finally:
+        await bot_module.shutdown()
+        await bot_module.bot.session.close()
+        await api.stop()
+
+    print(f"\n{'scenario':<16}{'updates':>8}{'err':>5}{'p50 ms':>9}{'p99 ms':>9}{'upd/s':>10}{'db ms':>9}{'queries':>9}")
+    for r in results:
+        print(f"{r['scenario']:<16}{r['updates']:>8}{r['errors']:>5}{r['p50_ms']:>9.2f}{r['p99_ms']:>9.2f}"
+              f"{r['throughput']:>10.1f}{r['db_ms']:>9.1f}{r['db_queries']:>9}")
+    print("\nBot API calls per skenario:")
+    for r in results:
+        calls = ", ".join(f"{k}={v}" for k, v in sorted(r["api_calls"].items()))
+        print(f"  {r['scenario']:<16}{calls or '-'}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark offline bot.py")
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--media", type=int, default=200)
+    parser.add_argument("--updates", type=int, default=2000, help="update per skenario")
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--api-latency-ms", type=float, default=10)
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--scenarios", default="start,fsub,top,referral,fsm,broadcast")
+    parser.add_argument("--real-limits", action="store_true", help="pakai rate limit Telegram asli")
+    asyncio.run(main(parser.parse_args()))
@@ -1,19 +1,52 @@
 #asu
 import asyncio
+import bisect
+import gzip
+import heapq
+import itertools
+import json
+import multiprocessing
+import queue
+import secrets
+import shutil
+import signal
+import sqlite3
+import tempfile
+import time
+import traceback
 import uuid
 import os
+from array import array
+from collections import OrderedDict, deque
+from contextvars import ContextVar
 import aiosqlite
+from contextlib import asynccontextmanager
 from aiogram import Bot, Dispatcher, F
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.enums import ParseMode
+from aiogram.exceptions import (
+    TelegramRetryAfter, TelegramForbiddenError, TelegramBadRequest,
+    TelegramNetworkError, TelegramServerError
+)
 from aiogram.types import (
     Message, InlineKeyboardMarkup, InlineKeyboardButton, 
-    FSInputFile, CallbackQuery, ChatMemberUpdated # <--- Ganti/Tambah ini
+    FSInputFile, CallbackQuery, ChatMemberUpdated, # <--- Ganti/Tambah ini
+    ErrorEvent
 )
 from aiogram.filters import CommandStart, Command, StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.storage.base import BaseStorage, StorageKey, DefaultKeyBuilder
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.dispatcher.middlewares.base import BaseMiddleware
+from aiogram.dispatcher.event.bases import UNHANDLED
+from aiogram.dispatcher.flags import get_flag
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web, ClientSession, ClientTimeout, ClientError
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from apscheduler.triggers.cron import CronTrigger
 
 # ================= KONFIGURASI =================
 BOT_TOKEN = os.getenv("BOT_TOKEN")
@@ -22,21 +55,225 @@ try:
 except (TypeError, ValueError):
     OWNER_ID = 0
 
-bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.MARKDOWN))
-dp = Dispatcher(storage=MemoryStorage())
+# Mode jalan: "polling" (default), "webhook", atau "workers" (1 poller + N proses handler)
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+WORKERS = int(os.getenv("WORKERS", str(os.cpu_count() or 2)))  # jumlah proses di mode workers
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL", "")  # kosong = ga set_webhook (buat tes lokal)
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+# Tanpa secret & tanpa URL publik (tes lokal) default cuma dengar di loopback
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0" if WEBHOOK_SECRET or WEBHOOK_BASE_URL else "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+
+# Bot API server custom (Local Bot API Server / fake server di bench.py), kosong = api.telegram.org
+BOT_API_URL = os.getenv("BOT_API_URL", "")
+
+bot = Bot(
+    token=BOT_TOKEN,
+    session=AiohttpSession(api=TelegramAPIServer.from_base(BOT_API_URL)) if BOT_API_URL else None,
+    default=DefaultBotProperties(parse_mode=ParseMode.MARKDOWN),
+)
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-DB_NAME = os.path.join(BASE_DIR, "media.db")
-
-async def loading_anim(msg: Message):
-    frames = ["⏳ Loading", "⏳ Loading.", "⏳ Loading..", "⏳ Loading..."]
-    temp_msg = await msg.answer(frames[0])
-    for _ in range(2): # 2 kali putaran
-        for frame in frames:
+DB_NAME = os.getenv("DB_PATH") or os.path.join(BASE_DIR, "media.db")
+DB_READERS = int(os.getenv("DB_READERS", "3"))  # jumlah koneksi baca di pool
+
+# ================= FSM STORAGE =================
+FSM_HOT_MAX = int(os.getenv("FSM_HOT_MAX", "5000"))               # sesi maksimal di memori
+FSM_IDLE_TTL = int(os.getenv("FSM_IDLE_TTL", "900"))              # detik idle sebelum dilepas dari memori
+FSM_FLUSH_INTERVAL = float(os.getenv("FSM_FLUSH_INTERVAL", "1"))  # detik antar tulis ke SQLite
+FSM_EXPIRE_DAYS = int(os.getenv("FSM_EXPIRE_DAYS", "7"))          # sesi terbengkalai dihapus dari SQLite
+
+class TieredStorage(BaseStorage):
+    """FSM storage dua tingkat: memori (hot, terbatas + idle TTL) di atas tabel fsm_storage.
+
+    Perubahan ditandai dirty dan ditulis sekaligus tiap FSM_FLUSH_INTERVAL, jadi
+    upload multi-part yang setengah jalan tetap ada setelah restart. Sesi yang
+    idle dilepas dari memori dan di-load lagi dari SQLite kalau user balik.
+    """
+
+    def __init__(self):
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_business_connection_id=True, with_destiny=True)
+        self.hot = OrderedDict()  # key -> [state, data, last_access]
+        self.persisted = set()    # key yang punya baris di fsm_storage
+        self.dirty = set()
+        self.task = None
+        self.loads = 0
+        self.evictions = 0
+        self.writes = 0
+        self._next_purge = 0.0
+
+    async def _entry(self, key: StorageKey):
+        k = self.key_builder.build(key)
+        entry = self.hot.get(k)
+        if entry is None:
+            # User yang ga punya sesi tersimpan (mayoritas) ga perlu nanya SQLite
+            row = None
+            if k in self.persisted:
+                row = await database.fetchone("SELECT state, data FROM fsm_storage WHERE key=?", (k,))
+            # Bisa saja sudah diisi coroutine lain selama await di atas
+            entry = self.hot.get(k)
+            if entry is None:
+                entry = [row[0], json.loads(row[1])] if row else [None, {}]
+                entry.append(0.0)
+                self.hot[k] = entry
+                self.loads += 1
+        entry[2] = time.monotonic()
+        self.hot.move_to_end(k)
+        return k, entry
+
+    async def set_state(self, key: StorageKey, state=None):
+        k, entry = await self._entry(key)
+        entry[0] = state.state if isinstance(state, State) else state
+        self.dirty.add(k)
+
+    async def get_state(self, key: StorageKey):
+        return (await self._entry(key))[1][0]
+
+    async def set_data(self, key: StorageKey, data):
+        k, entry = await self._entry(key)
+        entry[1] = dict(data)
+        self.dirty.add(k)
+
+    async def get_data(self, key: StorageKey):
+        return (await self._entry(key))[1][1].copy()
+
+    async def load_keys(self):
+        rows = await database.fetchall("SELECT key FROM fsm_storage")
+        self.persisted = {r[0] for r in rows}
+
+    async def flush(self):
+        if not self.dirty: return
+        keys, self.dirty = self.dirty, set()
+        upserts, deletes = [], []
+        for k in keys:
+            entry = self.hot.get(k)
+            if entry is None: continue
+            if entry[0] is None and not entry[1]:
+                deletes.append((k,))
+            else:
+                upserts.append((k, entry[0], json.dumps(entry[1], default=str)))
+        try:
+            async with database.transaction("fsm_flush") as db:
+                if upserts:
+                    await db.executemany(
+                        "INSERT INTO fsm_storage (key, state, data, updated_at) VALUES (?, ?, ?, CURRENT_TIMESTAMP) "
+                        "ON CONFLICT (key) DO UPDATE SET state=excluded.state, data=excluded.data, updated_at=excluded.updated_at",
+                        upserts)
+                if deletes:
+                    await db.executemany("DELETE FROM fsm_storage WHERE key=?", deletes)
+        except Exception as e:
+            print(f"Error flush FSM: {e}")
+            self.dirty |= keys
+            return
+        self.persisted.update(k for k, _, _ in upserts)
+        self.persisted.difference_update(k for (k,) in deletes)
+        self.writes += len(upserts) + len(deletes)
+
+    def evict(self):
+        # Cuma entry bersih yang boleh dilepas; yang dirty nunggu flush berikutnya
+        cutoff = time.monotonic() - FSM_IDLE_TTL
+        for k in list(self.hot):
+            entry = self.hot[k]
+            over = len(self.hot) > FSM_HOT_MAX
+            if entry[2] >= cutoff and not over: break
+            if k in self.dirty: continue
+            del self.hot[k]
+            self.evictions += 1
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(FSM_FLUSH_INTERVAL)
+            await self.flush()
+            self.evict()
+            if time.monotonic() >= self._next_purge:
+                self._next_purge = time.monotonic() + 3600
+                await database.execute("DELETE FROM fsm_storage WHERE updated_at < datetime('now', ?)",
+                                       (f"-{FSM_EXPIRE_DAYS} days",))
+                await self.load_keys()
+
+    def start(self):
+        self.task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        if database.writer: await self.flush()
+
+    def stats(self):
+        return {"hot": len(self.hot), "persisted": len(self.persisted), "dirty": len(self.dirty), "loads": self.loads,
+                "evictions": self.evictions, "writes": self.writes}
+
+fsm_storage = TieredStorage()
+dp = Dispatcher(storage=fsm_storage)
+
+PROGRESS_GRACE = 0.5           # kerjaan yang selesai lebih cepat dari ini ga perlu animasi
+PROGRESS_EDIT_INTERVAL = 1.5   # detik minimal antar edit frame
+CHAT_ACTION_INTERVAL = 4.5     # chat action Telegram hilang sendiri setelah ~5 detik
+
+class ProgressIndicator:
+    """Animasi loading yang jalan di background selama kerjaan asli jalan.
+
+        async with ProgressIndicator(msg) as progress:
+            ...kerja...
+            progress.done("✅ BERHASIL")
+
+    Begitu blok selesai animasi dihentikan dan pesan loading diganti status akhir
+    (atau dikirim sebagai pesan baru kalau kerjaan selesai sebelum animasi muncul).
+    Tanpa done() (mis. kerjaan error) pesan loading dihapus.
+    Dengan action="typing" dst, cuma kirim send_chat_action tanpa pesan sementara.
+    """
+
+    FRAMES = ["⏳ Loading", "⏳ Loading.", "⏳ Loading..", "⏳ Loading..."]
+
+    def __init__(self, msg: Message, action: str = None):
+        self.msg = msg
+        self.action = action
+        self.temp_msg = None
+        self.sending = None  # kiriman frame pertama, dipisah biar ga ikut ke-cancel di tengah jalan
+        self.final_text = None
+        self.task = None
+
+    def done(self, text: str):
+        self.final_text = text
+
+    async def _animate(self):
+        await asyncio.sleep(PROGRESS_GRACE)
+        if self.action:
+            while True:
+                await bot.send_chat_action(self.msg.chat.id, self.action)
+                await asyncio.sleep(CHAT_ACTION_INTERVAL)
+        self.sending = asyncio.ensure_future(self.msg.answer(self.FRAMES[0]))
+        self.temp_msg = await asyncio.shield(self.sending)
+        i = 1
+        while True:
+            await asyncio.sleep(PROGRESS_EDIT_INTERVAL)
+            await self.temp_msg.edit_text(self.FRAMES[i % len(self.FRAMES)])
+            i += 1
+
+    async def __aenter__(self):
+        self.task = asyncio.create_task(self._animate())
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.task.cancel()
+        await asyncio.gather(self.task, return_exceptions=True)
+        if self.sending and not self.temp_msg:
+            # Di-cancel pas frame pertama masih dikirim: tunggu hasilnya biar ga jadi pesan yatim
+            sent = (await asyncio.gather(self.sending, return_exceptions=True))[0]
+            if not isinstance(sent, BaseException): self.temp_msg = sent
+        if self.final_text:
+            if self.temp_msg:
+                await self.temp_msg.edit_text(self.final_text)
+            else:
+                await self.msg.answer(self.final_text)
+        elif self.temp_msg:
             try:
-                await temp_msg.edit_text(frame)
-                await asyncio.sleep(0.3)
-            except: break
-    return temp_msg
+                await self.temp_msg.delete()
+            except Exception:
+                pass
+        return False
 # ================= STATES =================
 class AdminStates(StatesGroup):
     waiting_for_channel_post = State()
@@ -63,77 +300,943 @@ class PostMedia(StatesGroup):
     waiting_for_post_title = State()
     waiting_for_final_confirm = State()
 
-# ================= DATABASE HELPER =================
-async def init_db():
-    async with aiosqlite.connect(DB_NAME) as db:
-        # Tabel Media Dasar
-        await db.execute("CREATE TABLE IF NOT EXISTS media (code TEXT PRIMARY KEY, file_id TEXT, type TEXT, caption TEXT, title TEXT)")
-        await db.execute("CREATE TABLE IF NOT EXISTS users (user_id INTEGER PRIMARY KEY, joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)")
-        await db.execute("CREATE TABLE IF NOT EXISTS config (key TEXT PRIMARY KEY, value TEXT)")
-        await db.execute("CREATE TABLE IF NOT EXISTS admins (admin_id INTEGER PRIMARY KEY)")
-        await db.execute("CREATE TABLE IF NOT EXISTS titles (id INTEGER PRIMARY KEY AUTOINCREMENT, title TEXT)")
-        
-        # Fitur 4 & 5: Content Analytics & Top Weekly
-        await db.execute("""CREATE TABLE IF NOT EXISTS views (
-            user_id INTEGER, 
-            media_code TEXT, 
-            viewed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            PRIMARY KEY (user_id, media_code))""")
-            
-        # Fitur 7: Multi Channel Post
-        await db.execute("CREATE TABLE IF NOT EXISTS channels (channel_id TEXT PRIMARY KEY, name TEXT)")
-        
-        # Fitur 11: Referral System
-        await db.execute("""CREATE TABLE IF NOT EXISTS referrals (
-            owner_id INTEGER, 
-            invited_user INTEGER PRIMARY KEY, 
-            status TEXT DEFAULT 'valid')""")
-
-async def init_db():
-    async with aiosqlite.connect(DB_NAME) as db:
-        # ... (kode create table kamu yang sudah ada) ...
-        
-        await db.commit()
+# ================= METRICS =================
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # 0 = /metrics mati (ga pernah nempel di app webhook)
+METRICS_PATH = "/metrics"
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)  # slot terakhir = +Inf
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, seconds: float):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+
+    def quantile(self, q: float):
+        """Perkiraan kasar: batas atas bucket tempat kuantil q jatuh."""
+        if not self.count: return 0.0
+        rank, seen = q * self.count, 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return LATENCY_BUCKETS[i] if i < len(LATENCY_BUCKETS) else float("inf")
+        return float("inf")
+
+class Metrics:
+    """Histogram latency + counter error per handler, statement DB dan method Bot API."""
+
+    FAMILIES = {
+        "handler": ("bot_handler_latency_seconds", "bot_handler_errors_total", "handler"),
+        "db": ("bot_db_query_seconds", "bot_db_errors_total", "statement"),
+        "api": ("bot_api_request_seconds", "bot_api_errors_total", "method"),
+        "job": ("bot_job_duration_seconds", "bot_job_errors_total", "job"),
+    }
+
+    def __init__(self):
+        self.histograms = {family: {} for family in self.FAMILIES}
+        self.errors = {family: {} for family in self.FAMILIES}
+
+    def observe(self, family, label, seconds, error=False):
+        hist = self.histograms[family].get(label)
+        if hist is None:
+            hist = self.histograms[family][label] = Histogram()
+        hist.observe(seconds)
+        if error:
+            self.errors[family][label] = self.errors[family].get(label, 0) + 1
+
+    def render_prometheus(self):
+        def esc(value):
+            return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", " ")
+
+        lines = []
+        for family, (hist_name, err_name, label_name) in self.FAMILIES.items():
+            lines.append(f"# TYPE {hist_name} histogram")
+            for label, hist in self.histograms[family].items():
+                lbl = f'{label_name}="{esc(label)}"'
+                cumulative = 0
+                for bound, n in zip(LATENCY_BUCKETS + ("+Inf",), hist.counts):
+                    cumulative += n
+                    lines.append(f'{hist_name}_bucket{{{lbl},le="{bound}"}} {cumulative}')
+                lines.append(f"{hist_name}_sum{{{lbl}}} {hist.total}")
+                lines.append(f"{hist_name}_count{{{lbl}}} {hist.count}")
+            lines.append(f"# TYPE {err_name} counter")
+            for label, n in self.errors[family].items():
+                lines.append(f'{err_name}{{{label_name}="{esc(label)}"}} {n}')
+        # Angka dari /stats ikut diekspor sebagai gauge
+        lines.append("# TYPE bot_stat gauge")
+        for source, values in collect_stats().items():
+            for key, value in values.items():
+                if isinstance(value, (int, float)):
+                    # bool juga int, tapi "True" bukan angka valid buat Prometheus
+                    lines.append(f'bot_stat{{source="{esc(source)}",key="{esc(key)}"}} {int(value) if isinstance(value, bool) else value}')
+        return "\n".join(lines) + "\n"
+
+    def summary(self, family, limit=8):
+        """Baris (label, count, avg_ms, p99_ms, errors) diurut total waktu terbesar."""
+        rows = []
+        for label, hist in self.histograms[family].items():
+            avg = hist.total / hist.count * 1000 if hist.count else 0
+            rows.append((label, hist.count, avg, hist.quantile(0.99) * 1000,
+                         self.errors[family].get(label, 0), hist.total))
+        rows.sort(key=lambda r: r[5], reverse=True)
+        return [r[:5] for r in rows[:limit]]
+
+metrics = Metrics()
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Inner middleware: ukur latency tiap handler (by nama fungsi) + hitung error."""
+
+    async def __call__(self, handler, event, data):
+        handler_obj = data.get("handler")
+        name = getattr(getattr(handler_obj, "callback", None), "__name__", "unknown")
+        started = time.perf_counter()
+        error = False
+        try:
+            return await handler(event, data)
+        except Exception:
+            error = True
+            raise
+        finally:
+            metrics.observe("handler", name, time.perf_counter() - started, error)
+
+class ApiMetricsMiddleware(BaseRequestMiddleware):
+    """Session middleware: hitung & ukur tiap call Bot API per method."""
 
-        # --- TAMBAHKAN KODE INI DI BAWAH COMMIT ---
+    async def __call__(self, make_request, bot, method):
+        started = time.perf_counter()
+        error = False
         try:
-            # Perintah ini untuk nambahin kolom 'title' ke tabel 'media' yang sudah ada
-            await db.execute("ALTER TABLE media ADD COLUMN title TEXT")
-            await db.commit()
-            print("✅ Berhasil menambah kolom title!")
-        except:
-            # Kalau kolomnya sudah ada (setelah running sekali), dia bakal ke sini
-            pass
-            
-        await db.commit()
-# ================= PAYMENT DATABASE =================
-async def init_payment_table():
-    async with aiosqlite.connect(DB_NAME) as db:
+            return await make_request(bot, method)
+        except Exception:
+            error = True
+            raise
+        finally:
+            metrics.observe("api", method.__api_method__, time.perf_counter() - started, error)
+
+async def metrics_endpoint(request: web.Request):
+    return web.Response(text=metrics.render_prometheus(), content_type="text/plain", charset="utf-8")
+
+for _observer in (dp.message, dp.callback_query, dp.chat_member):
+    _observer.middleware(HandlerMetricsMiddleware())
+
+metrics_runner = None
+
+async def start_metrics_server():
+    """Server Prometheus (kalau METRICS_PORT diisi), default cuma dengar di 127.0.0.1."""
+    global metrics_runner
+    app = web.Application()
+    app.router.add_get(METRICS_PATH, metrics_endpoint)
+    metrics_runner = web.AppRunner(app)
+    await metrics_runner.setup()
+    await web.TCPSite(metrics_runner, METRICS_HOST, METRICS_PORT).start()
+
+async def stop_metrics_server():
+    global metrics_runner
+    if metrics_runner:
+        await metrics_runner.cleanup()
+        metrics_runner = None
+
+# ================= DATABASE LAYER =================
+class Database:
+    """Satu koneksi writer + pool koneksi reader (WAL), dibuka sekali di main().
+
+    Semua helper lewat sini, jadi tidak ada lagi aiosqlite.connect per panggilan.
+    Tulis diserialkan pakai lock; baca jalan paralel di pool reader.
+    """
+
+    PRAGMAS = (
+        "PRAGMA journal_mode=WAL",
+        "PRAGMA synchronous=NORMAL",
+        "PRAGMA temp_store=MEMORY",
+        "PRAGMA cache_size=-16000",
+        "PRAGMA mmap_size=134217728",
+        "PRAGMA busy_timeout=5000",
+    )
+
+    def __init__(self, path: str, readers: int = DB_READERS):
+        self.path = path
+        self.reader_count = max(1, readers)
+        self.writer = None
+        self._readers = []
+        self._pool = None
+        self._write_lock = asyncio.Lock()
+
+    async def _connect(self, read_only: bool = False):
+        # cached_statements = cache prepared statement per koneksi (by SQL text)
+        conn = await aiosqlite.connect(self.path, cached_statements=256)
+        for pragma in self.PRAGMAS:
+            await conn.execute(pragma)
+        if read_only:
+            await conn.execute("PRAGMA query_only=ON")
+        return conn
+
+    async def open(self):
+        # Writer dulu biar mode WAL sudah aktif sebelum reader nyambung
+        self.writer = await self._connect()
+        self._pool = asyncio.Queue()
+        for _ in range(self.reader_count):
+            conn = await self._connect(read_only=True)
+            self._readers.append(conn)
+            self._pool.put_nowait(conn)
+
+    async def close(self):
+        async with self._write_lock:
+            for conn in self._readers:
+                await conn.close()
+            self._readers = []
+            if self.writer:
+                await self.writer.commit()
+                await self.writer.close()
+                self.writer = None
+
+    @asynccontextmanager
+    async def reader(self):
+        conn = await self._pool.get()
+        try:
+            yield conn
+        finally:
+            self._pool.put_nowait(conn)
+
+    async def fetchone(self, sql, params=()):
+        async with self.reader() as conn:
+            async with conn.execute(sql, params) as cur:
+                return await cur.fetchone()
+
+    async def fetchall(self, sql, params=()):
+        async with self.reader() as conn:
+            async with conn.execute(sql, params) as cur:
+                return await cur.fetchall()
+
+    async def execute(self, sql, params=()):
+        """Satu statement tulis + commit. Return rowcount."""
+        async with self._write_lock:
+            cur = await self.writer.execute(sql, params)
+            await self.writer.commit()
+            return cur.rowcount
+
+    async def executemany(self, sql, seq):
+        async with self._write_lock:
+            cur = await self.writer.executemany(sql, seq)
+            await self.writer.commit()
+            return cur.rowcount
+
+    @asynccontextmanager
+    async def transaction(self, label: str = "transaction"):
+        """Beberapa statement tulis dalam satu commit (rollback kalau error).
+
+        `label` cuma dipakai buat nama transaksi di metrics.
+        """
+        async with self._write_lock:
+            try:
+                yield self.writer
+                await self.writer.commit()
+            except BaseException:
+                await self.writer.rollback()
+                raise
+
+    async def backup_to(self, dest: str):
+        """Snapshot konsisten ke file lain (online backup API, di thread). Tulis tetap jalan."""
+        await asyncio.to_thread(_sqlite_copy, self.path, dest)
+
+    async def restore_from(self, src: str):
+        """Isi DB live diganti isi `src` dalam satu transaksi SQLite.
+
+        Bukan nimpa file: koneksi yang lagi kebuka (termasuk punya worker lain) tetap valid,
+        reader lihat data lama sampai copy-nya commit, writer di proses ini antre di lock.
+        """
+        async with self._write_lock:
+            await asyncio.to_thread(_sqlite_copy, src, self.path)
+
+def _sqlite_copy(src_path: str, dest_path: str):
+    src = sqlite3.connect(src_path)
+    dest = sqlite3.connect(dest_path, timeout=30)
+    try:
+        src.backup(dest)
+    finally:
+        dest.close()
+        src.close()
+
+class InstrumentedDatabase(Database):
+    """Database yang mencatat durasi tiap query (termasuk nunggu pool/lock) per statement."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._labels = {}
+
+    def _label(self, sql):
+        label = self._labels.get(sql)
+        if label is None:
+            label = self._labels[sql] = " ".join(sql.split())[:80]
+        return label
+
+    async def _timed(self, fn, sql, *args):
+        started = time.perf_counter()
+        error = False
+        try:
+            return await fn(sql, *args)
+        except Exception:
+            error = True
+            raise
+        finally:
+            metrics.observe("db", self._label(sql), time.perf_counter() - started, error)
+
+    async def fetchone(self, sql, params=()):
+        return await self._timed(super().fetchone, sql, params)
+
+    async def fetchall(self, sql, params=()):
+        return await self._timed(super().fetchall, sql, params)
+
+    async def execute(self, sql, params=()):
+        return await self._timed(super().execute, sql, params)
 
+    async def executemany(self, sql, seq):
+        return await self._timed(super().executemany, sql, seq)
+
+    @asynccontextmanager
+    async def transaction(self, label: str = "transaction"):
+        started = time.perf_counter()
+        error = False
+        try:
+            async with super().transaction(label) as db:
+                yield db
+        except BaseException:
+            error = True
+            raise
+        finally:
+            metrics.observe("db", f"[tx] {label}", time.perf_counter() - started, error)
+
+database = InstrumentedDatabase(DB_NAME)
+
+# ================= BACKUP & RESTORE =================
+BACKUP_GZIP = os.getenv("BACKUP_GZIP", "0") == "1"  # export DB dalam bentuk .db.gz
+
+def _gzip_file(path: str):
+    with open(path, "rb") as src, gzip.open(path + ".gz", "wb") as dest:
+        shutil.copyfileobj(src, dest)
+    os.remove(path)
+    return path + ".gz"
+
+def _check_backup(path: str):
+    """Validasi file upload buat restore (boleh .gz). Return path file .db yang siap dipakai."""
+    with open(path, "rb") as f:
+        magic = f.read(2)
+    if magic == b"\x1f\x8b":
+        with gzip.open(path, "rb") as src, open(path + ".db", "wb") as dest:
+            shutil.copyfileobj(src, dest)
+        path += ".db"
+    with open(path, "rb") as f:
+        if f.read(16) != b"SQLite format 3\x00":
+            raise ValueError("File bukan database SQLite.")
+    conn = sqlite3.connect(path)
+    try:
+        result = conn.execute("PRAGMA integrity_check").fetchall()
+    except sqlite3.DatabaseError as e:
+        raise ValueError(f"Database rusak: {e}")
+    finally:
+        conn.close()
+    if result != [("ok",)]:
+        raise ValueError("Integrity check gagal: " + "; ".join(r[0] for r in result[:3]))
+    return path
+
+async def export_backup(workdir: str):
+    """Snapshot DB ke `workdir`, opsional di-gzip. Return path file-nya."""
+    path = os.path.join(workdir, time.strftime("media-%Y%m%d-%H%M%S.db"))
+    await database.backup_to(path)
+    if BACKUP_GZIP:
+        path = await asyncio.to_thread(_gzip_file, path)
+    return path
+
+async def restore_backup(path: str):
+    """Validasi file di thread, copy ke DB live, migrasi, lalu semua cache dimuat ulang."""
+    path = await asyncio.to_thread(_check_backup, path)
+    try:
+        await database.restore_from(path)
+    except sqlite3.Error as e:
+        raise ValueError(f"Restore gagal: {e}")
+    await init_schema()
+    await reload_state()
+    notify_peers("reload")
+
+# ================= RUNTIME STATS =================
+# nama -> fungsi tanpa argumen yang return dict angka; ditampilkan di /stats
+STATS_SOURCES = {}
+
+def register_stats(name, fn):
+    STATS_SOURCES[name] = fn
+
+def collect_stats():
+    return {name: fn() for name, fn in STATS_SOURCES.items()}
+
+register_stats("fsm_storage", fsm_storage.stats)
+
+# ================= MIGRATIONS =================
+# Skema diversion pakai PRAGMA user_version. Tiap migrasi jalan sekali, berurutan,
+# dalam satu transaksi bareng bump versinya. Migrasi baru = tambah fungsi di MIGRATIONS,
+# jangan ubah migrasi lama. Semua pakai IF NOT EXISTS biar DB lama (versi 0 tapi
+# tabelnya sudah ada dari init_* versi dulu) tetap aman.
+
+async def _table_exists(db, name):
+    cur = await db.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (name,))
+    return await cur.fetchone() is not None
+
+async def _add_column(db, table, column, decl):
+    # ALTER TABLE cuma kalau kolomnya memang belum ada
+    cur = await db.execute(f"SELECT 1 FROM pragma_table_info('{table}') WHERE name=?", (column,))
+    if await cur.fetchone() is None:
+        await db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+async def migrate_base_tables(db):
+    await db.execute("CREATE TABLE IF NOT EXISTS media (code TEXT PRIMARY KEY, file_id TEXT, type TEXT, caption TEXT, title TEXT)")
+    await db.execute("CREATE TABLE IF NOT EXISTS users (user_id INTEGER PRIMARY KEY, joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)")
+    await db.execute("CREATE TABLE IF NOT EXISTS config (key TEXT PRIMARY KEY, value TEXT)")
+    await db.execute("CREATE TABLE IF NOT EXISTS admins (admin_id INTEGER PRIMARY KEY)")
+    await db.execute("CREATE TABLE IF NOT EXISTS titles (id INTEGER PRIMARY KEY AUTOINCREMENT, title TEXT)")
+    # Fitur 4 & 5: Content Analytics & Top Weekly
+    await db.execute("""CREATE TABLE IF NOT EXISTS views (
+        user_id INTEGER, 
+        media_code TEXT, 
+        viewed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (user_id, media_code))""")
+    # Fitur 7: Multi Channel Post
+    await db.execute("CREATE TABLE IF NOT EXISTS channels (channel_id TEXT PRIMARY KEY, name TEXT)")
+    # Fitur 11: Referral System
+    await db.execute("""CREATE TABLE IF NOT EXISTS referrals (
+        owner_id INTEGER, 
+        invited_user INTEGER PRIMARY KEY, 
+        status TEXT DEFAULT 'valid')""")
+    # DB lama yang media-nya belum punya kolom title
+    await _add_column(db, "media", "title", "TEXT")
+
+async def migrate_feature_tables(db):
+    await db.execute("""
+    CREATE TABLE IF NOT EXISTS payments (
+        invoice_id TEXT PRIMARY KEY,
+        user_id INTEGER,
+        amount INTEGER,
+        status TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+    await db.execute("""
+    CREATE TABLE IF NOT EXISTS fsm_storage (
+        key TEXT PRIMARY KEY,
+        state TEXT,
+        data TEXT,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+    # cursor = user_id terakhir yang sudah selesai diproses (users diurut by user_id)
+    await db.execute("""
+    CREATE TABLE IF NOT EXISTS broadcast_jobs (
+        job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        from_chat_id INTEGER,
+        message_id INTEGER,
+        admin_chat_id INTEGER,
+        progress_msg_id INTEGER,
+        cursor INTEGER DEFAULT 0,
+        total INTEGER DEFAULT 0,
+        sent INTEGER DEFAULT 0,
+        blocked INTEGER DEFAULT 0,
+        failed INTEGER DEFAULT 0,
+        status TEXT DEFAULT 'running',
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+
+async def migrate_view_rollup(db):
+    # Counter harian per media, diisi trigger tiap ada baris views baru.
+    # INSERT OR IGNORE yang ke-skip (user sudah pernah nonton) ga ikut kehitung.
+    backfill = not await _table_exists(db, "media_daily_views")
+    await db.execute("""
+    CREATE TABLE IF NOT EXISTS media_daily_views (
+        media_code TEXT,
+        day TEXT,
+        views INTEGER DEFAULT 0,
+        PRIMARY KEY (media_code, day)
+    ) WITHOUT ROWID
+    """)
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_media_daily_views_day ON media_daily_views (day)")
+    await db.execute("""
+    CREATE TRIGGER IF NOT EXISTS views_rollup AFTER INSERT ON views BEGIN
+        INSERT INTO media_daily_views (media_code, day, views) VALUES (NEW.media_code, date(NEW.viewed_at), 1)
+        ON CONFLICT (media_code, day) DO UPDATE SET views = views + 1;
+    END
+    """)
+    if backfill:
         await db.execute("""
-        CREATE TABLE IF NOT EXISTS payments (
-            invoice_id TEXT PRIMARY KEY,
-            user_id INTEGER,
-            amount INTEGER,
-            status TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
+        INSERT INTO media_daily_views (media_code, day, views)
+        SELECT media_code, date(viewed_at), COUNT(*) FROM views GROUP BY media_code, date(viewed_at)
         """)
 
-        await db.commit()
+async def migrate_referral_counts(db):
+    # referral_counts = counter per inviter, di-update bareng INSERT referrals (satu transaksi)
+    backfill = not await _table_exists(db, "referral_counts")
+    await db.execute("CREATE TABLE IF NOT EXISTS referral_counts (owner_id INTEGER PRIMARY KEY, total INTEGER DEFAULT 0)")
+    if backfill:
+        await db.execute("INSERT INTO referral_counts (owner_id, total) SELECT owner_id, COUNT(*) FROM referrals GROUP BY owner_id")
+
+async def migrate_hot_indexes(db):
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_views_media_time ON views (media_code, viewed_at)")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_referrals_owner ON referrals (owner_id)")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_payments_user_status ON payments (user_id, status)")
+
+async def migrate_invoices(db):
+    # payments jadi invoice VIP: pending -> approved -> link_sent, atau pending -> rejected
+    await _add_column(db, "payments", "kind", "TEXT DEFAULT 'vip'")
+    await _add_column(db, "payments", "user_name", "TEXT")
+    await _add_column(db, "payments", "proof_file_id", "TEXT")
+    await _add_column(db, "payments", "decided_by", "INTEGER")
+    await _add_column(db, "payments", "invite_link", "TEXT")
+    await _add_column(db, "payments", "updated_at", "TIMESTAMP")
+
+async def migrate_invite_pool(db):
+    # Link invite VIP sekali pakai yang dibikin duluan di background (lihat InvitePool)
+    await db.execute("""
+    CREATE TABLE IF NOT EXISTS invite_pool (
+        link TEXT PRIMARY KEY,
+        chat_id TEXT NOT NULL,
+        created_at INTEGER NOT NULL,
+        expire_at INTEGER NOT NULL,
+        status TEXT DEFAULT 'ready',
+        used_by INTEGER,
+        used_at INTEGER
+    )
+    """)
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_invite_pool_ready ON invite_pool (chat_id, status, created_at)")
+
+async def migrate_views_time_index(db):
+    # job views_compact nyari baris lama lewat viewed_at doang; idx_views_media_time ga kepakai
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_views_time ON views (viewed_at)")
+
+MIGRATIONS = [
+    (1, "tabel dasar", migrate_base_tables),
+    (2, "payments, fsm_storage, broadcast_jobs", migrate_feature_tables),
+    (3, "rollup views harian", migrate_view_rollup),
+    (4, "counter referral", migrate_referral_counts),
+    (5, "index query panas", migrate_hot_indexes),
+    (6, "kolom invoice di payments", migrate_invoices),
+    (7, "pool link invite VIP", migrate_invite_pool),
+    (8, "index views.viewed_at", migrate_views_time_index),
+]
+
+async def migrate():
+    """Jalankan migrasi yang versinya > user_version. Return jumlah migrasi yang jalan."""
+    current = (await database.fetchone("PRAGMA user_version"))[0]
+    applied = 0
+    for version, name, step in MIGRATIONS:
+        if version <= current: continue
+        async with database.transaction(f"migrate_{version}") as db:
+            # sqlite3 ga otomatis BEGIN sebelum DDL, jadi dibuka manual biar beneran satu transaksi
+            await db.execute("BEGIN")
+            await step(db)
+            await db.execute(f"PRAGMA user_version = {version}")
+        print(f"✅ Migrasi {version}: {name}")
+        applied += 1
+    if applied:
+        await database.execute("ANALYZE")
+    return applied
+
+# Lookup panas yang wajib kena index; dicek pakai EXPLAIN QUERY PLAN tiap startup.
+# (Di tabel yang isinya masih sedikit, SQLite kadang memang milih scan.)
+QUERY_PLAN_CHECKS = {
+    "media_by_code": "SELECT file_id, type, caption FROM media WHERE code=?",
+    "users_page": "SELECT user_id FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?",
+    "views_by_media": "SELECT COUNT(*) FROM views WHERE media_code=? AND viewed_at >= ?",
+    "referrals_by_owner": "SELECT COUNT(*) FROM referrals WHERE owner_id=?",
+    "referral_count": "SELECT total FROM referral_counts WHERE owner_id=?",
+    "payments_by_user": "SELECT invoice_id FROM payments WHERE user_id=? AND status=?",
+    "fsm_by_key": "SELECT state, data FROM fsm_storage WHERE key=?",
+    "views_compact_batch": "SELECT rowid FROM views WHERE viewed_at < datetime('now', ?) LIMIT ?",
+    "invite_pool_take": "SELECT link FROM invite_pool WHERE chat_id=? AND status='ready' AND expire_at > ? ORDER BY created_at LIMIT 1",
+}
+
+async def check_query_plans():
+    """Laporin query di QUERY_PLAN_CHECKS yang masih full scan. Return {nama: detail plan}."""
+    scans = {}
+    for name, sql in QUERY_PLAN_CHECKS.items():
+        params = (None,) * sql.count("?")
+        rows = await database.fetchall(f"EXPLAIN QUERY PLAN {sql}", params)
+        # "SCAN ... USING (COVERING) INDEX" juga full scan (cuma lewat index); yang aman SEARCH
+        full = [r[3] for r in rows if r[3].startswith("SCAN ")]
+        if full: scans[name] = full
+    for name, details in scans.items():
+        print(f"⚠️ Query {name} masih full scan: {'; '.join(details)}")
+    return scans
+
+# ================= RATE LIMIT =================
+class TokenBucket:
+    """Token bucket async: `rate` token/detik, burst sampai `capacity`.
+
+    pause() dipakai waktu Telegram balas RetryAfter, semua acquire ikut nunggu.
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+# ================= OUTBOUND SCHEDULER =================
+API_GLOBAL_RATE = float(os.getenv("API_GLOBAL_RATE", "30"))            # Telegram: ~30 msg/detik total
+API_PRIVATE_RATE = float(os.getenv("API_PRIVATE_RATE", "1"))           # ~1 msg/detik per chat private
+CHANNEL_RATE_PER_MIN = float(os.getenv("CHANNEL_RATE_PER_MIN", "20"))  # ~20 msg/menit per group/channel
+API_MAX_RETRIES = int(os.getenv("API_MAX_RETRIES", "3"))               # retry otomatis kalau kena RetryAfter
+
+PRIORITY_INTERACTIVE = 0  # balasan langsung ke user
+PRIORITY_NORMAL = 1       # posting channel, log
+PRIORITY_BACKGROUND = 2   # broadcast, digest referral
+PRIORITY_NAMES = ("interactive", "normal", "background")
+api_priority = ContextVar("api_priority", default=PRIORITY_INTERACTIVE)
+
+# Method yang kena limit kirim pesan. sendChatAction sengaja ga masuk.
+RATE_LIMITED_METHODS = {
+    "sendMessage", "sendPhoto", "sendVideo", "sendDocument", "sendAnimation", "sendAudio",
+    "sendVoice", "sendMediaGroup", "sendSticker", "copyMessage", "copyMessages",
+    "forwardMessage", "forwardMessages", "editMessageText", "editMessageCaption",
+    "editMessageMedia", "editMessageReplyMarkup",
+}
+
+class OutboundScheduler(BaseRequestMiddleware):
+    """Semua request Bot API lewat sini (middleware session).
+
+    Request kirim pesan nunggu token bucket per chat, lalu antre token global
+    berdasarkan prioritas (api_priority), jadi broadcast ga bisa nyerobot balasan
+    interaktif. RetryAfter di-handle otomatis: chat-nya di-pause lalu dicoba lagi.
+    """
+
+    def __init__(self):
+        self.global_bucket = TokenBucket(API_GLOBAL_RATE)
+        self.chat_buckets = {}
+        self.waiters = []  # heap (priority, seq, future)
+        self.seq = itertools.count()
+        self.pump_task = None
+        self.calls = 0
+        self.flood_waits = 0
+        self.wait_total = [0.0] * len(PRIORITY_NAMES)
+        self.wait_max = [0.0] * len(PRIORITY_NAMES)
+        self.granted = [0] * len(PRIORITY_NAMES)
+
+    def chat_bucket(self, chat_id):
+        key = str(chat_id)
+        bucket = self.chat_buckets.get(key)
+        if bucket is None:
+            if len(self.chat_buckets) >= 10000: self._prune_buckets()
+            # ID negatif / @username = group atau channel
+            shared = key.startswith("-") or key.startswith("@")
+            rate = CHANNEL_RATE_PER_MIN / 60 if shared else API_PRIVATE_RATE
+            # Mode workers: group/channel, owner & user shard lain bisa dikirimi semua worker,
+            # jadi limit per chat-nya dibagi rata kayak limit global
+            if worker_count > 1 and (shared or key == str(OWNER_ID) or not owns_user(int(key))):
+                bucket = TokenBucket(rate / worker_count, capacity=max(1, 3 / worker_count))
+            else:
+                bucket = TokenBucket(rate, capacity=3)
+            self.chat_buckets[key] = bucket
+        return bucket
+
+    def _prune_buckets(self):
+        # Bucket yang idle > 60 detik sudah penuh lagi, aman dibuang
+        cutoff = time.monotonic() - 60
+        for key in [k for k, b in self.chat_buckets.items()
+                    if b.updated < cutoff and b.paused_until < cutoff and not b._lock.locked()]:
+            del self.chat_buckets[key]
+
+    async def _acquire_global(self, priority):
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (priority, next(self.seq), fut))
+        if self.pump_task is None:
+            self.pump_task = asyncio.create_task(self._pump())
+        await fut
+
+    async def _pump(self):
+        try:
+            while self.waiters:
+                await self.global_bucket.acquire()
+                while self.waiters:
+                    _, _, fut = heapq.heappop(self.waiters)
+                    if not fut.done():
+                        fut.set_result(None)
+                        break
+        finally:
+            self.pump_task = None
+
+    async def __call__(self, make_request, bot, method):
+        self.calls += 1
+        chat_id = getattr(method, "chat_id", None)
+        limited = chat_id is not None and method.__api_method__ in RATE_LIMITED_METHODS
+        priority = api_priority.get()
+        for attempt in range(API_MAX_RETRIES + 1):
+            if limited:
+                started = time.monotonic()
+                await self.chat_bucket(chat_id).acquire()
+                await self._acquire_global(priority)
+                waited = time.monotonic() - started
+                self.granted[priority] += 1
+                self.wait_total[priority] += waited
+                self.wait_max[priority] = max(self.wait_max[priority], waited)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                self.flood_waits += 1
+                if attempt == API_MAX_RETRIES: raise
+                if limited:
+                    self.chat_bucket(chat_id).pause(e.retry_after)
+                else:
+                    await asyncio.sleep(e.retry_after)
+
+    def stats(self):
+        data = {"calls": self.calls, "flood_waits": self.flood_waits, "queue_depth": len(self.waiters),
+                "chat_buckets": len(self.chat_buckets), "global_rate": self.global_bucket.rate}
+        for p, name in enumerate(PRIORITY_NAMES):
+            avg = self.wait_total[p] / self.granted[p] if self.granted[p] else 0
+            data[f"{name}_sent"] = self.granted[p]
+            data[f"{name}_wait_avg_ms"] = round(avg * 1000, 1)
+            data[f"{name}_wait_max_ms"] = round(self.wait_max[p] * 1000, 1)
+        return data
+
+outbound = OutboundScheduler()
+bot.session.middleware(outbound)
+bot.session.middleware(ApiMetricsMiddleware())  # didaftar setelah scheduler = cuma ngukur call HTTP-nya
+register_stats("outbound", outbound.stats)
+
+# ================= CHANNEL FAN-OUT =================
+FANOUT_MAX_ATTEMPTS = 4
+
+async def send_with_retry(chat_id, send):
+    """Jalankan send() dengan retry. Return None kalau sukses, alasan gagal kalau tidak.
+
+    Pacing per chat dan RetryAfter biasa sudah diurus OutboundScheduler; di sini
+    cuma retry error jaringan/server dan flood wait yang lolos dari retry scheduler.
+    """
+    reason = None
+    for attempt in range(FANOUT_MAX_ATTEMPTS):
+        try:
+            await send()
+            return None
+        except TelegramRetryAfter as e:
+            reason = f"flood wait {e.retry_after}s"
+            await asyncio.sleep(e.retry_after)
+        except (TelegramNetworkError, TelegramServerError) as e:
+            reason = str(e)
+            await asyncio.sleep(2 ** attempt)
+        except Exception as e:
+            # Error permanen (bot bukan admin, chat ga ketemu, dll) ga usah di-retry
+            return str(e)
+    return reason
+
+async def fan_out(targets, make_send):
+    """Kirim ke semua target paralel. Return dict target -> alasan gagal (None = sukses)."""
+    token = api_priority.set(PRIORITY_NORMAL)
+    try:
+        results = await asyncio.gather(*(send_with_retry(t, make_send(t)) for t in targets))
+    finally:
+        api_priority.reset(token)
+    return dict(zip(targets, results))
+
+# ================= CONFIG CACHE =================
+class ConfigCache:
+    """Seluruh tabel config di memori, write-through lewat set_config.
+
+    Miss cuma terjadi kalau cache belum di-load (startup), dan satu miss = satu kali
+    baca tabel config dari DB. /update muat ulang lewat reload_state().
+    """
+
+    def __init__(self):
+        self.values = {}
+        self.loaded = False
+        self.hits = 0
+        self.misses = 0
+
+    async def load(self):
+        rows = await database.fetchall("SELECT key, value FROM config")
+        self.values = {k: v for k, v in rows}
+        self.loaded = True
+
+    async def get(self, key, default=None):
+        if self.loaded:
+            self.hits += 1
+        else:
+            self.misses += 1
+            await self.load()
+        return self.values.get(key, default)
+
+    def put(self, key, value):
+        if self.loaded: self.values[key] = value
+
+    def discard(self, key):
+        self.values.pop(key, None)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "keys": len(self.values)}
+
+config_cache = ConfigCache()
+register_stats("config_cache", config_cache.stats)
 
 async def get_config(key, default=None):
-    async with aiosqlite.connect(DB_NAME) as db:
-        async with db.execute("SELECT value FROM config WHERE key=?", (key,)) as cursor:
-            row = await cursor.fetchone()
-            return row[0] if row else default
+    return await config_cache.get(key, default)
 
 async def set_config(key, value):
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute("INSERT OR REPLACE INTO config (key, value) VALUES (?, ?)", (key, value))
-        await db.commit()
+    await database.execute("INSERT OR REPLACE INTO config (key, value) VALUES (?, ?)", (key, value))
+    config_cache.put(key, value)
+    notify_peers("config")
 
 # ================= VIP INVITE LINK =================
+INVITE_POOL_SIZE = int(os.getenv("INVITE_POOL_SIZE", "20"))          # target link siap pakai
+INVITE_POOL_LOW = int(os.getenv("INVITE_POOL_LOW", "5"))             # di bawah ini refill langsung
+INVITE_LINK_TTL = int(os.getenv("INVITE_LINK_TTL", str(7 * 86400)))  # umur link di Telegram (detik)
+INVITE_LINK_MIN_TTL = int(os.getenv("INVITE_LINK_MIN_TTL", "3600"))  # sisa umur segini = basi, di-revoke
+INVITE_POOL_INTERVAL = float(os.getenv("INVITE_POOL_INTERVAL", "300"))
+
+class InvitePool:
+    """Link invite `member_limit=1` buat vip_group yang dibikin duluan di background.
+    Approve cukup ambil satu baris (UPDATE ... RETURNING, jadi dua approve ga pernah dapat
+    link yang sama) lalu DM; create_chat_invite_link cuma jalan sinkron kalau pool kosong.
+    Link yang basi / grupnya sudah ganti / batal kepakai di-revoke pas refill."""
+
+    def __init__(self):
+        self.wakeup = asyncio.Event()
+        self.task = None
+        self.hits = 0
+        self.misses = 0
+        self.created = 0
+        self.revoked = 0
+        self.errors = 0
+        self.ready = 0
+
+    async def _create(self, vip_group):
+        now = int(time.time())
+        link = await bot.create_chat_invite_link(chat_id=vip_group, member_limit=1, expire_date=now + INVITE_LINK_TTL)
+        self.created += 1
+        return link.invite_link, now, now + INVITE_LINK_TTL
+
+    async def take(self, vip_group, user_id):
+        """Link sekali pakai buat user_id. Dari pool kalau ada, kalau kosong bikin langsung."""
+        now = int(time.time())
+        async with database.transaction("invite_take") as db:
+            async with db.execute(
+                "UPDATE invite_pool SET status='used', used_by=?, used_at=? WHERE link = ("
+                "SELECT link FROM invite_pool WHERE chat_id=? AND status='ready' AND expire_at > ? "
+                "ORDER BY created_at LIMIT 1) RETURNING link",
+                (user_id, now, str(vip_group), now + INVITE_LINK_MIN_TTL)) as cur:
+                rows = await cur.fetchall()
+            async with db.execute(
+                "SELECT COUNT(*) FROM invite_pool WHERE chat_id=? AND status='ready' AND expire_at > ?",
+                (str(vip_group), now + INVITE_LINK_MIN_TTL)) as cur:
+                self.ready = (await cur.fetchone())[0]
+        if self.ready < INVITE_POOL_LOW: await self.kick(peers=True)
+        if rows:
+            self.hits += 1
+            return rows[0][0]
+        self.misses += 1
+        link, now, expire_at = await self._create(vip_group)
+        await database.execute(
+            "INSERT INTO invite_pool (link, chat_id, created_at, expire_at, status, used_by, used_at) "
+            "VALUES (?, ?, ?, ?, 'used', ?, ?)", (link, str(vip_group), now, expire_at, user_id, now))
+        return link
+
+    async def discard(self, link):
+        # Link sudah keambil tapi DM-nya gagal: jangan dipakai lagi, revoke di refill berikutnya
+        await database.execute("UPDATE invite_pool SET status='stale' WHERE link=?", (link,))
+
+    async def kick(self, peers=False):
+        self.wakeup.set()
+        # Mode workers: refill cuma jalan di worker 0
+        if peers and self.task is None: notify_peers("invite_pool")
+
+    async def prune(self, vip_group):
+        now = int(time.time())
+        rows = await database.fetchall(
+            "SELECT link, chat_id FROM invite_pool WHERE status='stale' "
+            "OR (status='ready' AND (chat_id != ? OR expire_at <= ?))",
+            (str(vip_group or ""), now + INVITE_LINK_MIN_TTL))
+        for link, chat_id in rows:
+            try:
+                await bot.revoke_chat_invite_link(chat_id=chat_id, invite_link=link)
+                self.revoked += 1
+            except TelegramRetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+                break
+            except Exception:
+                pass  # sudah kadaluarsa / bot bukan admin lagi di grup lama
+            await database.execute("DELETE FROM invite_pool WHERE link=?", (link,))
+        # Riwayat link terpakai cukup disimpan selama umur link-nya
+        await database.execute("DELETE FROM invite_pool WHERE status='used' AND expire_at <= ?", (now,))
+
+    async def refill(self):
+        vip_group = await get_config("vip_group")
+        await self.prune(vip_group)
+        if not vip_group:
+            self.ready = 0
+            return
+        row = await database.fetchone(
+            "SELECT COUNT(*) FROM invite_pool WHERE chat_id=? AND status='ready' AND expire_at > ?",
+            (str(vip_group), int(time.time()) + INVITE_LINK_MIN_TTL))
+        self.ready = row[0]
+        while self.ready < INVITE_POOL_SIZE:
+            try:
+                link, now, expire_at = await self._create(vip_group)
+            except TelegramRetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+                continue
+            await database.execute(
+                "INSERT INTO invite_pool (link, chat_id, created_at, expire_at) VALUES (?, ?, ?, ?)",
+                (link, str(vip_group), now, expire_at))
+            self.ready += 1
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), INVITE_POOL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            try:
+                await self.refill()
+            except Exception as e:
+                # Grup belum diset benar / bot bukan admin: coba lagi interval berikutnya
+                self.errors += 1
+                print(f"Refill invite pool gagal: {e!r}")
+
+    def start(self):
+        self.task = asyncio.create_task(self._run())
+        self.wakeup.set()
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    def stats(self):
+        return {"ready": self.ready, "hits": self.hits, "misses": self.misses, "created": self.created,
+                "revoked": self.revoked, "errors": self.errors}
+
+invite_pool = InvitePool()
+register_stats("invite_pool", invite_pool.stats)
+
 async def send_vip_link(user_id: int):
 
     vip_group = await get_config("vip_group")
@@ -144,25 +1247,246 @@ async def send_vip_link(user_id: int):
 
     try:
 
-        link = await bot.create_chat_invite_link(
-            chat_id=vip_group,
-            member_limit=1
-        )
+        link = await invite_pool.take(vip_group, user_id)
 
         await bot.send_message(
             user_id,
-            f"✅ Payment diterima!\n\nLink VIP kamu:\n{link.invite_link}"
+            f"✅ Payment diterima!\n\nLink VIP kamu:\n{link}"
         )
 
     except Exception as e:
 
         await bot.send_message(user_id, f"❌ Error: {e}")
 
+# ================= VIP INVOICE =================
+# Tiap bukti transfer / klaim referral = satu baris payments. Status cuma maju lewat
+# compare-and-set (UPDATE ... WHERE status=<lama>), jadi approve dobel atau dua admin
+# barengan cuma satu yang menang; sisanya no-op dan cuma lihat status terbaru.
+INVOICE_COLUMNS = ("invoice_id", "user_id", "user_name", "kind", "status", "decided_by", "invite_link")
+INVOICE_STATUS_LABEL = {
+    "pending": "⏳ MENUNGGU",
+    "approved": "✅ DI-APPROVE (link belum terkirim)",
+    "rejected": "❌ DITOLAK",
+    "link_sent": "🔗 LINK TERKIRIM",
+}
+
+INVOICE_INSERT = ("INSERT OR IGNORE INTO payments (invoice_id, user_id, user_name, kind, proof_file_id, status, updated_at) "
+                  "VALUES (?, ?, ?, ?, ?, 'pending', CURRENT_TIMESTAMP)")
+
+async def create_invoice(invoice_id, user_id, user_name=None, kind="vip", proof_file_id=None):
+    """Idempotent: invoice_id yang sama ga bikin baris baru. True kalau baru dibuat."""
+    return await database.execute(INVOICE_INSERT, (invoice_id, user_id, user_name, kind, proof_file_id)) == 1
+
+async def get_invoice(invoice_id):
+    row = await database.fetchone(f"SELECT {', '.join(INVOICE_COLUMNS)} FROM payments WHERE invoice_id=?", (invoice_id,))
+    return dict(zip(INVOICE_COLUMNS, row)) if row else None
+
+async def transition_invoice(invoice_id, old, new, admin_id=None):
+    """Compare-and-set status. True = transisi ini yang menang.
+
+    Klaim referral yang ditolak dapat balik poinnya di transaksi yang sama.
+    """
+    async with database.transaction("invoice_transition") as db:
+        cur = await db.execute(
+            "UPDATE payments SET status=?, decided_by=COALESCE(?, decided_by), updated_at=CURRENT_TIMESTAMP "
+            "WHERE invoice_id=? AND status=?", (new, admin_id, invoice_id, old))
+        if cur.rowcount != 1: return False
+        if new == "rejected":
+            await db.execute(
+                "UPDATE referral_counts SET total = total + ? "
+                "WHERE owner_id = (SELECT user_id FROM payments WHERE invoice_id=? AND kind='referral')",
+                (REF_TARGET, invoice_id))
+    return True
+
+def invoice_view(inv):
+    """Teks + tombol pesan admin, murni dari baris DB (tanpa call API)."""
+    title = "📩 **KLAIM REFERRAL**" if inv["kind"] == "referral" else "💎 **BUKTI TRANSFER**"
+    text = (f"{title}\n\n"
+            f"User: `{inv['user_id']}`\n"
+            f"Nama: {inv['user_name'] or '-'}\n"
+            f"Invoice: `{inv['invoice_id']}`\n"
+            f"Status: {INVOICE_STATUS_LABEL.get(inv['status'], inv['status'])}")
+    if inv["decided_by"]: text += f"\nOleh: `{inv['decided_by']}`"
+    kb = []
+    if inv["status"] == "pending":
+        approve = InlineKeyboardButton(text="✅ APPROVE", callback_data=f"vip_inv:approve:{inv['invoice_id']}")
+        reject = "❌ TOLAK" if inv["kind"] == "referral" else "❌ REJECT"
+        kb.append([approve, InlineKeyboardButton(text=reject, callback_data=f"vip_inv:reject:{inv['invoice_id']}")])
+    elif inv["status"] == "approved":
+        kb.append([InlineKeyboardButton(text="🔁 KIRIM ULANG LINK", callback_data=f"vip_inv:resend:{inv['invoice_id']}")])
+    kb.append([InlineKeyboardButton(text="💬 CHAT USER", callback_data=f"reply:{inv['user_id']}")])
+    return text, InlineKeyboardMarkup(inline_keyboard=kb)
+
+async def deliver_vip_link(inv, vip_group):
+    """Kirim link VIP sekali. Klaim dulu approved -> link_sent; kalau gagal, dibalikin ke approved."""
+    if not await transition_invoice(inv["invoice_id"], "approved", "link_sent"):
+        return False
+    link = None
+    try:
+        # Fitur 2: Link otomatis max 1 orang (diambil dari pool)
+        link = await invite_pool.take(vip_group, inv["user_id"])
+        await bot.send_message(
+            inv["user_id"],
+            f"✅ **PEMBAYARAN DISETUJUI!**\n\nSelamat datang di VIP. Ini link akses kamu:\n{link}\n\n*Note: Link ini hanya bisa diklik satu kali.*"
+        )
+    except Exception:
+        if link: await invite_pool.discard(link)
+        await transition_invoice(inv["invoice_id"], "link_sent", "approved")
+        raise
+    await database.execute("UPDATE payments SET invite_link=? WHERE invoice_id=?", (link, inv["invoice_id"]))
+    return True
+
+# ================= ADMIN ROSTER & BOT IDENTITY =================
+class AdminRoster:
+    """Daftar admin di memori; di-load saat startup dan di-refresh tiap DB di-restore (reload_state)."""
+
+    def __init__(self):
+        self.ids = set()
+
+    async def load(self):
+        rows = await database.fetchall("SELECT admin_id FROM admins")
+        self.ids = {r[0] for r in rows}
+
+    def stats(self):
+        return {"admins": len(self.ids)}
+
+admin_roster = AdminRoster()
+register_stats("admin_roster", admin_roster.stats)
+bot_username = None  # diisi sekali di main() lewat load_bot_identity()
+
+async def load_bot_identity():
+    global bot_username
+    bot_username = (await bot.get_me()).username
+
+def deep_link(code):
+    return f"https://t.me/{bot_username}?start={code}"
+
 async def is_admin(user_id: int):
     if user_id == OWNER_ID: return True
-    async with aiosqlite.connect(DB_NAME) as db:
-        async with db.execute("SELECT admin_id FROM admins WHERE admin_id=?", (user_id,)) as cur:
-            return await cur.fetchone() is not None
+    return user_id in admin_roster.ids
+
+# ================= KNOWN USERS =================
+class KnownUsers:
+    """user_id yang sudah tercatat di tabel users, dalam array int64 terurut (8 byte/user).
+
+    /start dari user lama cukup binary search; cuma user baru yang bikin INSERT.
+    """
+
+    def __init__(self):
+        self.ids = array("q")
+        self.inserts = 0
+        self.skipped = 0
+
+    async def load(self):
+        rows = await database.fetchall("SELECT user_id FROM users ORDER BY user_id")
+        self.ids = array("q", (r[0] for r in rows))
+
+    def __contains__(self, user_id):
+        i = bisect.bisect_left(self.ids, user_id)
+        return i < len(self.ids) and self.ids[i] == user_id
+
+    async def remember(self, user_id: int):
+        if user_id in self:
+            self.skipped += 1
+            return False
+        # Tandai dulu sebelum await, biar /start beruntun dari user yang sama ga dobel INSERT
+        bisect.insort(self.ids, user_id)
+        try:
+            await database.execute("INSERT OR IGNORE INTO users (user_id) VALUES (?)", (user_id,))
+        except Exception:
+            del self.ids[bisect.bisect_left(self.ids, user_id)]
+            raise
+        self.inserts += 1
+        return True
+
+    def stats(self):
+        return {"users": len(self.ids), "memory_bytes": self.ids.buffer_info()[1] * self.ids.itemsize,
+                "inserts": self.inserts, "skipped": self.skipped}
+
+known_users = KnownUsers()
+register_stats("known_users", known_users.stats)
+
+# ================= FSUB CACHE =================
+FSUB_POSITIVE_TTL = int(os.getenv("FSUB_POSITIVE_TTL", "600"))  # detik, hasil "sudah join"
+FSUB_NEGATIVE_TTL = int(os.getenv("FSUB_NEGATIVE_TTL", "20"))   # detik, hasil "belum join"/error
+JOINED_STATUSES = ("member", "administrator", "creator")
+
+class FsubCache:
+    """Cache TTL per (user, channel) hasil get_chat_member.
+
+    Hasil positif disimpan lebih lama dari negatif. Update chat_member yang
+    masuk langsung menimpa entry, jadi user yang baru join ga perlu nunggu TTL.
+    """
+
+    def __init__(self):
+        self.entries = {}   # (user_id, channel) -> (joined, expires_at)
+        self.inflight = {}  # (user_id, channels) -> Task yang sedang jalan
+        self.hits = 0
+        self.misses = 0
+        self.collapsed = 0
+        self._puts = 0
+
+    def get(self, user_id, channel):
+        entry = self.entries.get((user_id, channel))
+        if entry is None:
+            return None
+        if entry[1] < time.monotonic():
+            del self.entries[(user_id, channel)]
+            return None
+        return entry[0]
+
+    def put(self, user_id, channel, joined):
+        ttl = FSUB_POSITIVE_TTL if joined else FSUB_NEGATIVE_TTL
+        self.entries[(user_id, channel)] = (joined, time.monotonic() + ttl)
+        self._puts += 1
+        if self._puts % 1000 == 0: self.prune()
+
+    def prune(self):
+        now = time.monotonic()
+        for key in [k for k, v in self.entries.items() if v[1] < now]:
+            del self.entries[key]
+
+    def observe(self, event: ChatMemberUpdated):
+        """Update cache dari event chat_member (join/leave di channel fsub)."""
+        if not event.chat.username: return
+        channel = event.chat.username.lower()
+        self.put(event.new_chat_member.user.id, channel, event.new_chat_member.status in JOINED_STATUSES)
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses,
+                "collapsed": self.collapsed, "inflight": len(self.inflight)}
+
+fsub_cache = FsubCache()
+register_stats("fsub_cache", fsub_cache.stats)
+
+async def _fetch_membership(user_id: int, channel: str):
+    try:
+        m = await bot.get_chat_member(chat_id=f"@{channel}", user_id=user_id)
+        joined = m.status in JOINED_STATUSES
+    except Exception:
+        # Kalau channel ga ketemu/bot bukan admin, anggep wajib join
+        joined = False
+    fsub_cache.put(user_id, channel, joined)
+    return joined
+
+async def _check_channels(user_id: int, channels: tuple):
+    status = {}
+    to_fetch = []
+    for ch in channels:
+        cached = fsub_cache.get(user_id, ch.lower())
+        if cached is None:
+            to_fetch.append(ch)
+        else:
+            fsub_cache.hits += 1
+            status[ch] = cached
+    if to_fetch:
+        fsub_cache.misses += len(to_fetch)
+        results = await asyncio.gather(*(_fetch_membership(user_id, ch.lower()) for ch in to_fetch))
+        status.update(zip(to_fetch, results))
+    return [ch for ch in channels if not status[ch]]
 
 async def check_membership(user_id: int):
     raw_targets = await get_config("fsub_channels")
@@ -170,28 +1494,407 @@ async def check_membership(user_id: int):
     
     # Pecah berdasarkan spasi dan buang string kosong/sampah
     targets = [t.strip() for t in raw_targets.split() if t.strip()]
-    unjoined = []
-    
+    channels = []
     for target in targets:
         clean_target = target.replace("https://t.me/", "").replace("@", "")
-        if not clean_target: continue # Lewatin kalau kosong
-        
+        if clean_target and clean_target not in channels: channels.append(clean_target)
+    if not channels: return []
+
+    # Cek paralel; user yang sama nge-spam /start / COBA LAGI cuma dapat satu lookup
+    key = (user_id, tuple(channels))
+    task = fsub_cache.inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_check_channels(user_id, key[1]))
+        fsub_cache.inflight[key] = task
+        task.add_done_callback(lambda _: fsub_cache.inflight.pop(key, None))
+    else:
+        fsub_cache.collapsed += 1
+    return list(await asyncio.shield(task))
+
+# ================= MEDIA CACHE =================
+MEDIA_CACHE_SIZE = int(os.getenv("MEDIA_CACHE_SIZE", "5000"))  # jumlah code yang disimpan
+MEDIA_NEGATIVE_CACHE_SIZE = int(os.getenv("MEDIA_NEGATIVE_CACHE_SIZE", "2000"))
+
+class LRUCache:
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+
+    def get(self, key, default=None):
+        if key not in self.data:
+            return default
+        self.data.move_to_end(key)
+        return self.data[key]
+
+    def put(self, key, value):
+        self.data[key] = value
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def pop(self, key):
+        self.data.pop(key, None)
+
+    def clear(self):
+        self.data.clear()
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+class MediaCache:
+    """LRU code -> (file_id, type, caption) di depan tabel media.
+
+    Code yang tidak ada disimpan di LRU terpisah, jadi scanner yang nge-spam
+    code ngawur ga nyentuh SQLite dan ga ngusir entry yang valid.
+    """
+
+    def __init__(self):
+        self.found = LRUCache(MEDIA_CACHE_SIZE)
+        self.missing = LRUCache(MEDIA_NEGATIVE_CACHE_SIZE)
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, code):
+        row = self.found.get(code)
+        if row is not None or self.missing.get(code):
+            self.hits += 1
+            return row
+        self.misses += 1
+        row = await database.fetchone("SELECT file_id, type, caption FROM media WHERE code=?", (code,))
+        if row:
+            self.put(code, tuple(row))
+        else:
+            self.missing.put(code, True)
+        return row
+
+    def put(self, code, row):
+        self.missing.pop(code)
+        self.found.put(code, row)
+
+    def clear(self):
+        self.found.clear()
+        self.missing.clear()
+
+    def stats(self):
+        return {"entries": len(self.found), "negative": len(self.missing),
+                "hits": self.hits, "misses": self.misses}
+
+media_cache = MediaCache()
+register_stats("media_cache", media_cache.stats)
+
+# ================= VIEW BUFFER =================
+VIEW_FLUSH_SIZE = int(os.getenv("VIEW_FLUSH_SIZE", "500"))          # flush kalau pending segini
+VIEW_FLUSH_INTERVAL = float(os.getenv("VIEW_FLUSH_INTERVAL", "2"))  # atau tiap N detik
+
+class ViewBuffer:
+    """Write-behind untuk tabel views: start_handler cuma nambah ke set di memori,
+    task background yang nulis ke SQLite pakai satu executemany per batch."""
+
+    def __init__(self):
+        self.pending = set()  # (user_id, media_code), otomatis dedup
+        self.oldest = None
+        self.wakeup = asyncio.Event()
+        self.task = None
+        self.written = 0
+        self.batches = 0
+        self.deduped = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+
+    def add(self, user_id, media_code):
+        key = (user_id, media_code)
+        if key in self.pending:
+            self.deduped += 1
+            return
+        if not self.pending: self.oldest = time.monotonic()
+        self.pending.add(key)
+        if len(self.pending) >= VIEW_FLUSH_SIZE: self.wakeup.set()
+
+    async def flush(self):
+        if not self.pending: return
+        batch, self.pending = list(self.pending), set()
+        started = time.monotonic()
         try:
-            m = await bot.get_chat_member(chat_id=f"@{clean_target}", user_id=user_id)
-            if m.status not in ("member", "administrator", "creator"):
-                unjoined.append(clean_target)
-        except Exception:
-            # Kalau channel ga ketemu/bot bukan admin, anggep wajib join
-            unjoined.append(clean_target)
-    return unjoined
+            await database.executemany("INSERT OR IGNORE INTO views (user_id, media_code) VALUES (?, ?)", batch)
+        except Exception as e:
+            # Balikin ke buffer, dicoba lagi di flush berikutnya
+            print(f"Error logging view: {e}")
+            self.pending.update(batch)
+            return
+        self.last_flush_ms = (time.monotonic() - started) * 1000
+        self.max_flush_ms = max(self.max_flush_ms, self.last_flush_ms)
+        self.written += len(batch)
+        self.batches += 1
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), VIEW_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            await self.flush()
+
+    def start(self):
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        await self.flush()
+
+    def stats(self):
+        age = time.monotonic() - self.oldest if self.pending and self.oldest else 0
+        return {"depth": len(self.pending), "oldest_pending_s": round(age, 2),
+                "written": self.written, "batches": self.batches, "deduped": self.deduped,
+                "last_flush_ms": round(self.last_flush_ms, 2), "max_flush_ms": round(self.max_flush_ms, 2)}
+
+view_buffer = ViewBuffer()
+register_stats("view_buffer", view_buffer.stats)
+
+# ================= MAINTENANCE JOBS =================
+SCHEDULER_TZ = os.getenv("SCHEDULER_TZ", "Asia/Jakarta")
+VIEWS_RETENTION_DAYS = int(os.getenv("VIEWS_RETENTION_DAYS", "90"))  # baris views lebih tua dari ini dipadatkan
+VIEWS_COMPACT_BATCH = int(os.getenv("VIEWS_COMPACT_BATCH", "5000"))  # baris per transaksi
+VACUUM_PAGES = int(os.getenv("VACUUM_PAGES", "0"))                   # halaman dibebaskan per run, 0 = semua
+VACUUM_CONVERT = os.getenv("VACUUM_CONVERT", "0") == "1"             # startup: ubah DB ke auto_vacuum incremental
+# Jadwal format crontab (zona SCHEDULER_TZ), kosong = job dimatikan.
+# incremental_vacuum baru bebasin halaman kalau DB sudah dikonversi (VACUUM_CONVERT=1 sekali).
+JOB_SCHEDULES = {
+    "views_compact": os.getenv("JOB_VIEWS_COMPACT_CRON", "30 3 * * *"),
+    "incremental_vacuum": os.getenv("JOB_VACUUM_CRON", "0 4 * * *"),
+    "analyze": os.getenv("JOB_ANALYZE_CRON", "30 4 * * *"),
+    "wal_checkpoint": os.getenv("JOB_CHECKPOINT_CRON", "*/15 * * * *"),
+}
+
+async def job_views_compact():
+    # Harusnya semua baris sudah kehitung trigger views_rollup; INSERT ... DO NOTHING cuma
+    # jaga-jaga buat hari yang belum punya baris rollup sebelum baris mentahnya dihapus.
+    cutoff = f"-{VIEWS_RETENTION_DAYS} days"
+    deleted = 0
+    while True:
+        async with database.transaction("views_compact") as db:
+            await db.execute("""
+                WITH batch AS (SELECT media_code, viewed_at FROM views WHERE viewed_at < datetime('now', ?) LIMIT ?)
+                INSERT INTO media_daily_views (media_code, day, views)
+                SELECT media_code, date(viewed_at), COUNT(*) FROM batch WHERE true GROUP BY media_code, date(viewed_at)
+                ON CONFLICT (media_code, day) DO NOTHING
+            """, (cutoff, VIEWS_COMPACT_BATCH))
+            cur = await db.execute("""
+                DELETE FROM views WHERE rowid IN
+                (SELECT rowid FROM views WHERE viewed_at < datetime('now', ?) LIMIT ?)
+            """, (cutoff, VIEWS_COMPACT_BATCH))
+            n = cur.rowcount
+        deleted += n
+        if n < VIEWS_COMPACT_BATCH: break
+        await asyncio.sleep(0)  # kasih giliran writer lain di sela batch
+    return {"deleted": deleted}
+
+async def check_auto_vacuum():
+    """Dipanggil di startup. Job incremental_vacuum cuma jalan kalau DB-nya auto_vacuum=INCREMENTAL;
+    pindah ke situ butuh VACUUM penuh sekali yang nahan semua tulis (di mode workers proses
+    lain bisa kena "database is locked"), makanya opt-in lewat VACUUM_CONVERT=1 dan cuma
+    di sini, sebelum update diproses. Status-nya kelihatan di /stats (maintenance)."""
+    async with database.transaction("auto_vacuum_check") as db:
+        # Dibaca dari writer: koneksi reader nyimpen nilai lama sampai dibuka ulang
+        mode = (await (await db.execute("PRAGMA auto_vacuum")).fetchone())[0]
+        if mode != 2 and VACUUM_CONVERT:
+            print("🧹 VACUUM penuh: ubah DB ke auto_vacuum=INCREMENTAL...")
+            await db.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            await db.execute("VACUUM")
+            mode = 2
+    if mode != 2:
+        print("ℹ️ auto_vacuum belum INCREMENTAL: job incremental_vacuum di-skip (set VACUUM_CONVERT=1 sekali)")
+    maintenance.auto_vacuum = mode
+    return mode
+
+async def job_incremental_vacuum():
+    async with database.transaction("incremental_vacuum") as db:
+        mode = maintenance.auto_vacuum = (await (await db.execute("PRAGMA auto_vacuum")).fetchone())[0]
+        if mode != 2:
+            # DB belum incremental: job ini ga pernah VACUUM penuh sendiri (lihat check_auto_vacuum)
+            return {"skipped": 1}
+        before = (await (await db.execute("PRAGMA freelist_count")).fetchone())[0]
+        # executescript, bukan execute: tiap step cuma bebasin satu halaman
+        await db.executescript(f"PRAGMA incremental_vacuum({VACUUM_PAGES});")
+        after = (await (await db.execute("PRAGMA freelist_count")).fetchone())[0]
+    return {"freed_pages": before - after}
+
+async def job_analyze():
+    await database.execute("ANALYZE")
+    return {}
+
+async def job_wal_checkpoint():
+    async with database.transaction("wal_checkpoint") as db:
+        busy, log_pages, done = await (await db.execute("PRAGMA wal_checkpoint(TRUNCATE)")).fetchone()
+    return {"busy": busy, "wal_pages": log_pages, "checkpointed": done}
+
+class Maintenance:
+    """Job perawatan DB di AsyncIOScheduler. max_instances=1 = job ga pernah jalan dobel,
+    coalesce = run yang ketinggalan (bot mati/sibuk) digabung jadi satu."""
+
+    JOBS = {
+        "views_compact": job_views_compact,
+        "incremental_vacuum": job_incremental_vacuum,
+        "analyze": job_analyze,
+        "wal_checkpoint": job_wal_checkpoint,
+    }
+
+    def __init__(self):
+        self.scheduler = None
+        self.auto_vacuum = None  # PRAGMA auto_vacuum terakhir dibaca, 2 = INCREMENTAL
+        self.runs = {}
+        self.errors = {}
+        self.last = {}
+
+    async def run(self, name):
+        started = time.perf_counter()
+        error = False
+        try:
+            result = await self.JOBS[name]()
+        except Exception as e:
+            error = True
+            result = {}
+            print(f"Job {name} gagal: {e!r}")
+        finally:
+            elapsed = time.perf_counter() - started
+            metrics.observe("job", name, elapsed, error)
+            self.runs[name] = self.runs.get(name, 0) + 1
+            if error: self.errors[name] = self.errors.get(name, 0) + 1
+        self.last[name] = {"last_ms": round(elapsed * 1000, 1), **result}
+
+    def start(self):
+        self.scheduler = AsyncIOScheduler(timezone=SCHEDULER_TZ)
+        for name, cron in JOB_SCHEDULES.items():
+            if not cron: continue
+            self.scheduler.add_job(self.run, CronTrigger.from_crontab(cron, timezone=SCHEDULER_TZ), args=(name,),
+                                   id=name, max_instances=1, coalesce=True, misfire_grace_time=600)
+        self.scheduler.start()
+
+    def stop(self):
+        if self.scheduler:
+            self.scheduler.shutdown(wait=False)
+            self.scheduler = None
+
+    def stats(self):
+        out = {}
+        if self.auto_vacuum is not None:
+            # 0 = job incremental_vacuum cuma di-skip terus sampai VACUUM_CONVERT=1
+            out["auto_vacuum_incremental"] = int(self.auto_vacuum == 2)
+        for name in self.JOBS:
+            out[f"{name}_runs"] = self.runs.get(name, 0)
+            out[f"{name}_errors"] = self.errors.get(name, 0)
+            for key, value in self.last.get(name, {}).items():
+                out[f"{name}_{key}"] = value
+        return out
+
+maintenance = Maintenance()
+register_stats("maintenance", maintenance.stats)
+
+# ================= UPDATE EXECUTOR =================
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "32"))       # handler jalan barengan max segini, 0 = inline
+UPDATE_QUEUE_MAX = int(os.getenv("UPDATE_QUEUE_MAX", "1000"))  # update antre max segini, lebih = polling nunggu
+
+class UpdateExecutor(BaseMiddleware):
+    """Outer middleware update: user beda diproses paralel (dibatasi UPDATE_WORKERS),
+    update dari user/chat yang sama tetap berurutan biar flow FSM (PostMedia dkk) aman.
+    Dipasang sebelum middleware FSM bawaan: state baru dibaca waktu update-nya jalan,
+    bukan waktu diantrekan (kalau ga, pesan kedua masih lihat state sebelum update pertama)."""
+
+    def __init__(self, workers=UPDATE_WORKERS, queue_max=UPDATE_QUEUE_MAX):
+        self.enabled = workers > 0
+        self.sem = asyncio.Semaphore(max(workers, 1))
+        self.slots = asyncio.Semaphore(max(queue_max, 1))
+        self.queues = {}    # key -> deque (handler, event, data)
+        self.tasks = set()
+        self.pending = 0
+        self.running = 0
+        self.processed = 0
+        self.errors = 0
+        self.backpressure_waits = 0
+
+    @staticmethod
+    def _key(data):
+        user, chat = data.get("event_from_user"), data.get("event_chat")
+        if user: return ("u", user.id)
+        if chat: return ("c", chat.id)
+        return None
+
+    async def __call__(self, handler, event, data):
+        key = self._key(data)
+        handler = album_middleware.collect(key, handler, event, data)
+        if handler is None: return  # part album, ikut diproses bareng part pertamanya
+        if not self.enabled or key is None:
+            return await handler(event, data)
+        if self.slots.locked(): self.backpressure_waits += 1
+        await self.slots.acquire()
+        self.pending += 1
+        queue = self.queues.get(key)
+        if queue is None:
+            queue = self.queues[key] = deque()
+            task = asyncio.create_task(self._drain(key, queue))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+        queue.append((handler, event, data))
+
+    async def _drain(self, key, queue):
+        while queue:
+            handler, event, data = queue.popleft()
+            try:
+                async with self.sem:
+                    self.running += 1
+                    try:
+                        await handler(event, data)
+                    finally:
+                        self.running -= 1
+                self.processed += 1
+            except Exception as e:
+                self.errors += 1
+                await self._report(event, data, e)
+            finally:
+                self.pending -= 1
+                self.slots.release()
+        del self.queues[key]
+
+    async def _report(self, event, data, error):
+        """Update yang diantrekan sudah lewat ErrorsMiddleware bawaan, jadi errornya dilempar
+        ke observer `errors` dispatcher di sini; yang ga ketangkep dicetak lengkap + traceback."""
+        try:
+            response = await dp.propagate_event(
+                update_type="error", event=ErrorEvent(update=event, exception=error), **data)
+            if response is not UNHANDLED: return
+        except Exception as e:
+            error = e  # handler error-nya sendiri yang gagal
+        print(f"Error proses update {getattr(event, 'update_id', '?')}: {error!r}")
+        traceback.print_exception(error)
+
+    async def wait_idle(self, timeout=30):
+        """Dipanggil pas shutdown: tunggu antrean habis sebelum DB ditutup."""
+        if self.tasks:
+            await asyncio.wait(set(self.tasks), timeout=timeout)
+
+    def stats(self):
+        return {"enabled": int(self.enabled), "pending": self.pending, "running": self.running,
+                "active_keys": len(self.queues), "processed": self.processed, "errors": self.errors,
+                "backpressure_waits": self.backpressure_waits}
+
+update_executor = UpdateExecutor()
+# Urutan outer middleware: Errors -> UserContext -> executor -> FSM
+dp.update.outer_middleware.unregister(dp.fsm)
+dp.update.outer_middleware(update_executor)
+dp.update.outer_middleware(dp.fsm)
+register_stats("update_executor", update_executor.stats)
 
 # ================= KEYBOARDS =================
 async def get_titles_kb():
     kb = []
-    async with aiosqlite.connect(DB_NAME) as db:
-        async with db.execute("SELECT title FROM titles ORDER BY id DESC LIMIT 10") as cur:
-            async for row in cur:
-                kb.append([InlineKeyboardButton(text=row[0], callback_data=f"t_sel:{row[0][:20]}")])
+    for row in await database.fetchall("SELECT title FROM titles ORDER BY id DESC LIMIT 10"):
+        kb.append([InlineKeyboardButton(text=row[0], callback_data=f"t_sel:{row[0][:20]}")])
     kb.append([InlineKeyboardButton(text="➕ TAMBAH JUDUL", callback_data="add_title_btn")])
     return InlineKeyboardMarkup(inline_keyboard=kb)
 
@@ -205,9 +1908,7 @@ def member_main_kb():
 # ================= MEMBER & FSUB =================
 @dp.message(CommandStart())
 async def start_handler(m: Message):
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute("INSERT OR IGNORE INTO users (user_id) VALUES (?)", (m.from_user.id,))
-        await db.commit()
+    await known_users.remember(m.from_user.id)
 
     args = m.text.split()
     target_code = args[1] if len(args) > 1 else "none"
@@ -223,21 +1924,14 @@ async def start_handler(m: Message):
         return await m.answer("⚠️ **AKSES DIKUNCI**\nSilahkan join channel yang muncul di bawah ini untuk lanjut.", reply_markup=InlineKeyboardMarkup(inline_keyboard=kb_list))
 
     if target_code != "none":
-        async with aiosqlite.connect(DB_NAME) as db:
-            async with db.execute("SELECT file_id, type, caption FROM media WHERE code=?", (target_code,)) as cur:
-                row = await cur.fetchone()
-                if row:
-                    # LOGIKA ANALYTICS (Fitur 4)
-                    try:
-                        await db.execute("INSERT OR IGNORE INTO views (user_id, media_code) VALUES (?, ?)", 
-                                         (m.from_user.id, target_code))
-                        await db.commit()
-                    except Exception as e:
-                        print(f"Error logging view: {e}")
-                                       
-                    if row[1] == "photo": await bot.send_photo(m.chat.id, row[0], caption=row[2], protect_content=True)
-                    else: await bot.send_video(m.chat.id, row[0], caption=row[2], protect_content=True)
-                    return
+        row = await media_cache.get(target_code)
+        if row:
+            # LOGIKA ANALYTICS (Fitur 4) - ditulis ke DB di background
+            view_buffer.add(m.from_user.id, target_code)
+                               
+            if row[1] == "photo": await bot.send_photo(m.chat.id, row[0], caption=row[2], protect_content=True)
+            else: await bot.send_video(m.chat.id, row[0], caption=row[2], protect_content=True)
+            return
 
     await m.answer(f"👋 Halo {m.from_user.first_name}!", reply_markup=member_main_kb())
 
@@ -256,15 +1950,91 @@ async def check_sub_cb(c: CallbackQuery):
     )
     await start_handler(new_m)
 
+# ================= ALBUM BUFFER =================
+ALBUM_WINDOW = float(os.getenv("ALBUM_WINDOW", "0.8"))  # detik hening setelah pesan terakhir album
+
+class Album(list):
+    """Pesan satu media_group_id, urut message_id."""
+    consumed = False  # True = handler ber-flag album sudah nanganin semuanya
+
+class AlbumMiddleware(BaseMiddleware):
+    """Pesan satu media_group_id dikumpulin dulu, handler dipanggil sekali dengan
+    `album` (urut message_id). Cuma buat handler yang ditandai flags={"album": True}.
+
+    Ngumpulinnya di collect(), dipanggil UpdateExecutor sebelum diantrekan: part pertama
+    jadi satu item di antrean user, part berikutnya nempel ke item itu. Item-nya nunggu
+    album hening ALBUM_WINDOW dulu, jadi update berikutnya dari user yang sama baru jalan
+    setelah handler album selesai (state FSM-nya sudah ke-set), dan handler album tetap
+    lewat middleware metrics + jalur error dispatcher kayak update biasa."""
+
+    def __init__(self, window=ALBUM_WINDOW):
+        self.window = window
+        self.groups = {}  # (key executor, media_group_id) -> {"parts", "last"}
+        self.albums = 0
+        self.messages = 0
+
+    def collect(self, key, handler, event, data):
+        """Return handler yang harus dijalankan buat update ini, None = part album yang ikut item lain."""
+        message = getattr(event, "message", None)
+        if key is None or message is None or not message.media_group_id:
+            return handler
+        self.messages += 1
+        group_key = (key, message.media_group_id)
+        group = self.groups.get(group_key)
+        if group is not None:
+            group["parts"].append((event, data))
+            group["last"] = time.monotonic()
+            return None
+        group = self.groups[group_key] = {"parts": [(event, data)], "last": time.monotonic()}
+
+        async def run_album(event, data):
+            return await self._flush(group_key, group, handler)
+        return run_album
+
+    async def _flush(self, group_key, group, handler):
+        while (delay := group["last"] + self.window - time.monotonic()) > 0:
+            await asyncio.sleep(delay)
+        del self.groups[group_key]
+        parts = sorted(group["parts"], key=lambda p: p[0].message.message_id)
+        album = Album(event.message for event, _ in parts)
+        self.albums += 1
+        event, data = parts[0]
+        result = await handler(event, {**data, "album": album})
+        if not album.consumed:
+            # Ga ada handler album yang kena: part sisanya diproses satu-satu kayak biasa
+            for event, data in parts[1:]:
+                await handler(event, data)
+        return result
+
+    async def __call__(self, handler, event, data):
+        album = data.pop("album", None)
+        if album is not None and get_flag(data, "album"):
+            album.consumed = True
+            data["album"] = album
+        return await handler(event, data)
+
+    def stats(self):
+        return {"buffering": len(self.groups), "albums": self.albums, "messages": self.messages}
+
+album_middleware = AlbumMiddleware()
+dp.message.middleware(album_middleware)
+register_stats("album", album_middleware.stats)
+
 # ================= LOGIKA AUTO POST (MULTI-PART) =================
-@dp.message(F.chat.type == "private", (F.photo | F.video | F.document), StateFilter(None))
-async def admin_upload(m: Message, state: FSMContext):
-    if not await is_admin(m.from_user.id): return
+def media_of(m: Message):
     fid = m.photo[-1].file_id if m.photo else (m.video.file_id if m.video else m.document.file_id)
     mtype = "photo" if m.photo else "video"
-    await state.update_data(temp_fid=fid, temp_type=mtype, temp_caption=(m.caption or ""), parts=[])
+    return fid, mtype, (m.caption or "")
+
+@dp.message(F.chat.type == "private", (F.photo | F.video | F.document), StateFilter(None), flags={"album": True})
+async def admin_upload(m: Message, state: FSMContext, album: list[Message] | None = None):
+    if not await is_admin(m.from_user.id): return
+    pending = [media_of(x) for x in album or [m]]
+    fid, mtype, caption = pending[0]
+    await state.update_data(temp_fid=fid, temp_type=mtype, temp_caption=caption, pending_parts=pending, parts=[])
     await state.set_state(PostMedia.waiting_for_post_title)
-    await m.reply("📝 **PILIH JUDUL:**", reply_markup=await get_titles_kb())
+    note = f" ({len(pending)} part dari album)" if len(pending) > 1 else ""
+    await m.reply(f"📝 **PILIH JUDUL:**{note}", reply_markup=await get_titles_kb())
 
 @dp.callback_query(PostMedia.waiting_for_post_title, F.data.startswith("t_sel:"))
 async def select_title_handler(c: CallbackQuery, state: FSMContext):
@@ -278,28 +2048,29 @@ async def add_new_title_btn(c: CallbackQuery, state: FSMContext):
 
 @dp.message(AdminStates.waiting_for_add_title)
 async def process_save_title(m: Message, state: FSMContext):
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute("INSERT INTO titles (title) VALUES (?)", (m.text,))
-        await db.commit()
+    await database.execute("INSERT INTO titles (title) VALUES (?)", (m.text,))
     await add_part_to_list(m, state, m.text)
 
 async def add_part_to_list(msg, state, p_title):
     data = await state.get_data()
-    code = uuid.uuid4().hex[:15]
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute("INSERT OR IGNORE INTO media (code, file_id, type, caption) VALUES (?, ?, ?, ?)", 
-                         (code, data['temp_fid'], data['temp_type'], data['temp_caption']))
-        await db.commit()
+    # Album = banyak part sekaligus, tetap satu executemany (satu commit)
+    pending = data.get('pending_parts') or [(data['temp_fid'], data['temp_type'], data['temp_caption'])]
+    rows = [(uuid.uuid4().hex[:15], *media) for media in pending]
+    await database.executemany("INSERT OR IGNORE INTO media (code, file_id, type, caption) VALUES (?, ?, ?, ?)", rows)
+    for code, *media in rows:
+        media_cache.put(code, tuple(media))
     
     parts = data.get('parts', [])
-    parts.append(code)
-    await state.update_data(parts=parts, current_title=p_title)
+    first = len(parts) + 1
+    parts.extend(code for code, *_ in rows)
+    await state.update_data(parts=parts, current_title=p_title, pending_parts=None)
     
     kb = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="➕ TAMBAH PART LAIN", callback_data="add_more_part")],
         [InlineKeyboardButton(text="🚀 POST SEKARANG", callback_data="final_post")]
     ])
-    await msg.answer(f"✅ Part {len(parts)} siap.\nJudul: **{p_title}**", reply_markup=kb)
+    label = f"Part {first}-{len(parts)}" if len(rows) > 1 else f"Part {len(parts)}"
+    await msg.answer(f"✅ {label} siap.\nJudul: **{p_title}**", reply_markup=kb)
     await state.set_state(PostMedia.waiting_for_final_confirm)
 
 @dp.callback_query(PostMedia.waiting_for_final_confirm, F.data == "final_post")
@@ -324,9 +2095,7 @@ async def handle_manual_cover(m: Message, state: FSMContext):
     await show_channel_selection(m, state)
 
 async def show_channel_selection(m: Message, state: FSMContext):
-    async with aiosqlite.connect(DB_NAME) as db:
-        async with db.execute("SELECT channel_id FROM channels") as cur:
-            rows = await cur.fetchall()
+    rows = await database.fetchall("SELECT channel_id FROM channels")
             
     if not rows:
         return await m.answer("❌ Daftarkan channel dulu di /panel!")
@@ -350,10 +2119,8 @@ async def execute_posting(c: CallbackQuery, state: FSMContext):
     # 1. DEFINISIKAN TARGETS (PENTING!)
     targets = []
     if target == "all":
-        async with aiosqlite.connect(DB_NAME) as db:
-            async with db.execute("SELECT channel_id FROM channels") as cur:
-                rows = await cur.fetchall()
-                targets = [r[0] for r in rows]
+        rows = await database.fetchall("SELECT channel_id FROM channels")
+        targets = [r[0] for r in rows]
     else:
         # Jika cuma satu channel, masukkan ke dalam list
         targets = [target]
@@ -362,11 +2129,10 @@ async def execute_posting(c: CallbackQuery, state: FSMContext):
         return await c.answer("❌ Tidak ada channel tujuan!", show_alert=True)
 
     # 2. Buat Keyboard Part
-    bot_info = await bot.get_me()
     kb_rows = []
     row = []
     for i, code in enumerate(parts, 1):
-        row.append(InlineKeyboardButton(text=f"Part {i}", url=f"https://t.me/{bot_info.username}?start={code}"))
+        row.append(InlineKeyboardButton(text=f"Part {i}", url=deep_link(code)))
         if len(row) == 2:
             kb_rows.append(row)
             row = []
@@ -376,48 +2142,52 @@ async def execute_posting(c: CallbackQuery, state: FSMContext):
     mode = await get_config("cover_mode", "OFF")
     cover_to_use = await get_config("cover_file_id") if mode == "ON" else data.get("manual_cover")
 
-    # 4. MULAI KIRIM
-    success = 0
-    for ch_id in targets:
-        try:
-            if cover_to_use:
-                await bot.send_photo(
-                    ch_id, 
-                    cover_to_use, 
-                    caption=f" **{p_title}**\n\n", 
-                    reply_markup=InlineKeyboardMarkup(inline_keyboard=kb_rows)
-                )
-            else:
-                await bot.send_message(
-                    ch_id, 
-                    f" **{p_title}**\n\n", 
-                    reply_markup=InlineKeyboardMarkup(inline_keyboard=kb_rows)
-                )
-            success += 1
-        except Exception as e:
-            print(f"Gagal kirim ke {ch_id}: {e}")
+    # 4. MULAI KIRIM (paralel, pacing per channel)
+    def make_send(ch_id):
+        if cover_to_use:
+            return lambda: bot.send_photo(
+                ch_id, 
+                cover_to_use, 
+                caption=f" **{p_title}**\n\n", 
+                reply_markup=InlineKeyboardMarkup(inline_keyboard=kb_rows)
+            )
+        return lambda: bot.send_message(
+            ch_id, 
+            f" **{p_title}**\n\n", 
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=kb_rows)
+        )
 
-    await c.message.edit_text(f"✅ Berhasil dipost ke {success} channel.")
+    async with ProgressIndicator(c.message, action="typing"):
+        results = await fan_out(targets, make_send)
+    failed = {ch: err for ch, err in results.items() if err}
+    text = f"✅ Berhasil dipost ke {len(targets) - len(failed)} channel."
+    if failed:
+        text += f"\n\n❌ Gagal ({len(failed)}):\n"
+        for ch_id, err in failed.items():
+            print(f"Gagal kirim ke {ch_id}: {err}")
+            reason = err.replace("`", "'")[:150]
+            text += f"• `{ch_id}`: `{reason}`\n"
+    await c.message.edit_text(text)
     await state.clear()
-@dp.message(F.chat.type == "private", (F.photo | F.video | F.document), StateFilter(PostMedia.waiting_for_final_confirm))
-async def handle_next_part(m: Message, state: FSMContext):
+@dp.message(F.chat.type == "private", (F.photo | F.video | F.document), StateFilter(PostMedia.waiting_for_final_confirm),
+            flags={"album": True})
+async def handle_next_part(m: Message, state: FSMContext, album: list[Message] | None = None):
     data = await state.get_data()
-    fid = m.photo[-1].file_id if m.photo else (m.video.file_id if m.video else m.document.file_id)
-    mtype = "photo" if m.photo else "video"
-    await state.update_data(temp_fid=fid, temp_type=mtype, temp_caption=(m.caption or ""))
+    pending = [media_of(x) for x in album or [m]]
+    fid, mtype, caption = pending[0]
+    await state.update_data(temp_fid=fid, temp_type=mtype, temp_caption=caption, pending_parts=pending)
     await add_part_to_list(m, state, data['current_title'])
 
 @dp.callback_query(PostMedia.waiting_for_final_confirm, F.data == "final_post")
 async def final_post_handler(c: CallbackQuery, state: FSMContext):
     data = await state.get_data()
     parts, p_title = data['parts'], data['current_title']
-    bot_user = (await bot.get_me()).username
     
     # Generate Keyboard Parts
     kb_rows = []
     row = []
     for i, code in enumerate(parts, 1):
-        row.append(InlineKeyboardButton(text=f"Part {i}", url=f"https://t.me/{bot_user}?start={code}"))
+        row.append(InlineKeyboardButton(text=f"Part {i}", url=deep_link(code)))
         if len(row) == 2: kb_rows.append(row); row = []
     if row: kb_rows.append(row)
     
@@ -426,16 +2196,16 @@ async def final_post_handler(c: CallbackQuery, state: FSMContext):
     cover_mode = await get_config("cover_mode", "OFF")
     cover_file = await get_config("cover_file_id")
     
-    load = await loading_anim(c.message)
-    try:
-        if cover_mode == "ON" and cover_file:
-            await bot.send_photo(ch_id, cover_file, caption=f"🎬 **{p_title}**", reply_markup=InlineKeyboardMarkup(inline_keyboard=kb_rows))
-        else:
-            # Jika mode OFF, kirim tanpa cover atau kirim file part 1 sebagai cover
-            await bot.send_message(ch_id, f"🎬 **{p_title}**\n\nSilahkan pilih part di bawah:", reply_markup=InlineKeyboardMarkup(inline_keyboard=kb_rows))
-        await load.edit_text("✅ BERHASIL DI POST!")
-    except Exception as e:
-        await load.edit_text(f"❌ GAGAL: {e}")
+    async with ProgressIndicator(c.message) as progress:
+        try:
+            if cover_mode == "ON" and cover_file:
+                await bot.send_photo(ch_id, cover_file, caption=f"🎬 **{p_title}**", reply_markup=InlineKeyboardMarkup(inline_keyboard=kb_rows))
+            else:
+                # Jika mode OFF, kirim tanpa cover atau kirim file part 1 sebagai cover
+                await bot.send_message(ch_id, f"🎬 **{p_title}**\n\nSilahkan pilih part di bawah:", reply_markup=InlineKeyboardMarkup(inline_keyboard=kb_rows))
+            progress.done("✅ BERHASIL DI POST!")
+        except Exception as e:
+            progress.done(f"❌ GAGAL: {e}")
     
     await state.clear()
 # ================= MEMBER INTERACTION (FORWARDED) =================
@@ -476,25 +2246,15 @@ async def preview_vip(c: CallbackQuery):
 
 @dp.message(MemberStates.waiting_for_vip_ss, F.photo)
 async def process_vip_ss(m: Message, state: FSMContext):
+    # Tiap bukti transfer dicatat jadi invoice pending dulu
+    invoice_id = uuid.uuid4().hex[:12]
+    await create_invoice(invoice_id, m.from_user.id, m.from_user.full_name, proof_file_id=m.photo[-1].file_id)
+    inv = await get_invoice(invoice_id)
+
     # Kirim ke Admin (Owner)
     await m.forward(OWNER_ID)
-    
-    # Tombol buat Admin ambil tindakan
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [
-            InlineKeyboardButton(text="✅ APPROVE", callback_data=f"vip_action:approve:{m.from_user.id}"),
-            InlineKeyboardButton(text="❌ REJECT", callback_data=f"vip_action:reject:{m.from_user.id}")
-        ],
-        [InlineKeyboardButton(text="💬 CHAT USER", callback_data=f"reply:{m.from_user.id}")]
-    ])
-    
-    await bot.send_message(
-        OWNER_ID, 
-        f"💎 **BUKTI TRANSFER BARU**\n\n"
-        f"User: `{m.from_user.id}`\n"
-        f"Nama: {m.from_user.full_name}",
-        reply_markup=kb
-    )
+    text, kb = invoice_view(inv)
+    await bot.send_message(OWNER_ID, text, reply_markup=kb)
     await m.reply("✅ Bukti transfer telah dikirim ke Admin. Mohon tunggu proses verifikasi.")
     await state.clear()
 
@@ -547,9 +2307,7 @@ async def toggle_cover_handler(c: CallbackQuery):
 @dp.callback_query(F.data == "set_post")
 async def set_post_menu(c: CallbackQuery):
     # Menampilkan list channel yang sudah terdaftar
-    async with aiosqlite.connect(DB_NAME) as db:
-        async with db.execute("SELECT channel_id FROM channels") as cur:
-            rows = await cur.fetchall()
+    rows = await database.fetchall("SELECT channel_id FROM channels")
     
     text = "📢 **DAFTAR CHANNEL POSTING**\n\n"
     if rows:
@@ -571,9 +2329,7 @@ async def add_ch_start(c: CallbackQuery, state: FSMContext):
 
 @dp.message(AdminStates.waiting_for_channel_post)
 async def save_new_ch(m: Message, state: FSMContext):
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute("INSERT OR IGNORE INTO channels (channel_id) VALUES (?)", (m.text.strip(),))
-        await db.commit()
+    await database.execute("INSERT OR IGNORE INTO channels (channel_id) VALUES (?)", (m.text.strip(),))
     await m.reply("✅ Channel ditambahkan ke list!")
     await state.clear()
 
@@ -587,16 +2343,30 @@ async def process_fsub(m: Message, state: FSMContext):
 
 @dp.callback_query(F.data == "menu_db", F.from_user.id == OWNER_ID)
 async def send_db_cb(c: CallbackQuery):
-    if os.path.exists(DB_NAME): await c.message.reply_document(FSInputFile(DB_NAME))
     await c.answer()
+    workdir = tempfile.mkdtemp(prefix="backup-")
+    try:
+        path = await export_backup(workdir)
+        await c.message.reply_document(FSInputFile(path))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
 
 @dp.message(Command("update"))
 async def update_database(m: Message):
     if not await is_admin(m.from_user.id): return
     if not m.reply_to_message or not m.reply_to_message.document: return await m.reply("❌ Reply .db")
     file = await bot.get_file(m.reply_to_message.document.file_id)
-    await bot.download_file(file.file_path, DB_NAME)
-    await init_db(); await m.reply("✅ UPDATED")
+    # Download ke file sementara dulu; DB live baru disentuh setelah file lolos integrity check
+    workdir = tempfile.mkdtemp(prefix="restore-")
+    try:
+        path = os.path.join(workdir, "upload")
+        await bot.download_file(file.file_path, path)
+        await restore_backup(path)
+    except ValueError as e:
+        return await m.reply(f"❌ {e}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    await m.reply("✅ UPDATED")
 
 @dp.callback_query(F.data.startswith("reply:"))
 async def reply_cb(c: CallbackQuery, state: FSMContext):
@@ -610,57 +2380,82 @@ async def process_reply_send(m: Message, state: FSMContext):
     except: await m.reply("❌ Gagal")
     await state.clear()
 
-@dp.callback_query(F.data.startswith("vip_action:"))
-async def vip_decision(c: CallbackQuery):
+@dp.callback_query(F.data.startswith("vip_inv:"))
+async def invoice_decision(c: CallbackQuery):
     # Cek apakah yang mencet beneran admin
     if not await is_admin(c.from_user.id):
         return await c.answer("Lu bukan admin!", show_alert=True)
+    _, action, invoice_id = c.data.split(":", 2)
+    await decide_invoice(c, action, invoice_id)
 
-    data = c.data.split(":")
-    action = data[1]     # approve atau reject
-    target_id = int(data[2]) # ID user yang mau di-acc
-    
-    log_ch = await get_config("log_group") # Ambil ID grup log dari database
-    
-    if action == "approve":
+@dp.callback_query(F.data.startswith("vip_action:"))
+async def vip_decision(c: CallbackQuery):
+    # Tombol lama (sebelum ada invoice): invoice_id diturunkan dari pesan admin-nya,
+    # jadi pencet ulang tombol yang sama tetap kena invoice yang sama.
+    if not await is_admin(c.from_user.id):
+        return await c.answer("Lu bukan admin!", show_alert=True)
+    _, action, target_id = c.data.split(":")
+    invoice_id = f"legacy-{c.message.chat.id}-{c.message.message_id}"
+    await create_invoice(invoice_id, int(target_id))
+    await decide_invoice(c, action, invoice_id)
+
+async def decide_invoice(c: CallbackQuery, action: str, invoice_id: str):
+    inv = await get_invoice(invoice_id)
+    if not inv:
+        return await c.answer("Invoice tidak ditemukan.", show_alert=True)
+    notice = None
+
+    if action in ("approve", "resend"):
         vip_group = await get_config("vip_group")
         if not vip_group: 
             return await c.answer("❌ Error: Group VIP belum diset di /panel!", show_alert=True)
-        
-        try:
-            # Fitur 2: Link otomatis max 1 orang
-            link = await bot.create_chat_invite_link(chat_id=vip_group, member_limit=1)
-            
-            await bot.send_message(
-                target_id, 
-                f"✅ **PEMBAYARAN DISETUJUI!**\n\nSelamat datang di VIP. Ini link akses kamu:\n{link.invite_link}\n\n*Note: Link ini hanya bisa diklik satu kali.*"
-            )
-            await c.message.edit_text(f"✅ User `{target_id}` Berhasil di-Approve.")
+        if action == "approve" and not await transition_invoice(invoice_id, "pending", "approved", c.from_user.id):
+            notice = "Invoice ini sudah diproses."
+        else:
+            try:
+                if await deliver_vip_link(inv, vip_group):
+                    await log_vip_join(inv)
+                else:
+                    notice = "Link sudah/sedang dikirim admin lain."
+            except Exception as e:
+                notice = f"Gagal buat link: {e}"
 
-            # Fitur 3: Kirim ke VIP JOIN LOGGER
-            if log_ch:
-                try:
-                    # Ambil info user buat di log
-                    u = await bot.get_chat(target_id)
-                    log_msg = (
-                        f"👥 **VIP JOIN LOGGER**\n"
-                        f"━━━━━━━━━━━━━━━\n"
-                        f"👤 **Nama:** [{u.first_name}](tg://user?id={target_id})\n"
-                        f"🆔 **ID:** `{target_id}`\n"
-                        f"🔗 **Profil:** [Klik Disini](tg://user?id={target_id})\n"
-                        f"✅ **Status:** Manual Approved"
-                    )
-                    await bot.send_message(log_ch, log_msg)
-                except: pass # Biar ga eror kalau bot belum join grup log
-                
-        except Exception as e:
-            await c.answer(f"Gagal buat link: {e}", show_alert=True)
-            
     elif action == "reject":
-        try:
-            await bot.send_message(target_id, "❌ **PEMBAYARAN DITOLAK**\n\nMohon maaf, bukti transfer kamu tidak valid atau tidak terbaca. Silahkan hubungi admin.")
-            await c.message.edit_text(f"❌ User `{target_id}` Berhasil di-Reject.")
-        except: pass
+        if await transition_invoice(invoice_id, "pending", "rejected", c.from_user.id):
+            if inv["kind"] == "referral":
+                text = "❌ **KLAIM REFERRAL DITOLAK**\n\nMohon maaf, klaim kamu belum bisa diproses. Poin kamu sudah dikembalikan, silahkan hubungi admin atau klaim ulang nanti."
+            else:
+                text = "❌ **PEMBAYARAN DITOLAK**\n\nMohon maaf, bukti transfer kamu tidak valid atau tidak terbaca. Silahkan hubungi admin."
+            try:
+                await bot.send_message(inv["user_id"], text)
+            except: pass
+        else:
+            notice = "Invoice ini sudah diproses."
+
+    text, kb = invoice_view(await get_invoice(invoice_id))
+    try:
+        await c.message.edit_text(text, reply_markup=kb)
+    except TelegramBadRequest:
+        pass  # isi pesan sama (message is not modified)
+    await c.answer(notice or "", show_alert=bool(notice))
+
+async def log_vip_join(inv):
+    # Fitur 3: Kirim ke VIP JOIN LOGGER (nama diambil dari invoice, ga perlu get_chat)
+    log_ch = await get_config("log_group") # Ambil ID grup log dari database
+    if not log_ch: return
+    target_id = inv["user_id"]
+    name = inv["user_name"] or str(target_id)
+    try:
+        log_msg = (
+            f"👥 **VIP JOIN LOGGER**\n"
+            f"━━━━━━━━━━━━━━━\n"
+            f"👤 **Nama:** [{name}](tg://user?id={target_id})\n"
+            f"🆔 **ID:** `{target_id}`\n"
+            f"🔗 **Profil:** [Klik Disini](tg://user?id={target_id})\n"
+            f"✅ **Status:** Manual Approved"
+        )
+        await bot.send_message(log_ch, log_msg)
+    except: pass # Biar ga eror kalau bot belum join grup log
 
 @dp.callback_query(F.data == "set_post")
 async def set_post_cb(c: CallbackQuery, state: FSMContext):
@@ -710,33 +2505,198 @@ async def set_vip_group_btn(c: CallbackQuery, state: FSMContext):
 async def save_vip_group(m: Message, state: FSMContext):
 
     await set_config("vip_group", m.text.strip())
+    await invite_pool.kick(peers=True)  # link grup lama di-revoke, pool diisi buat grup baru
 
     await m.reply("✅ VIP group set")
 
     await state.clear()
 
+# ================= BROADCAST ENGINE =================
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))  # pesan/detik, limit global Telegram ~30
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "20"))
+BROADCAST_PAGE = 200          # user per batch; progress disimpan tiap batch
+BROADCAST_EDIT_INTERVAL = 5   # detik antar edit pesan progress
+BROADCAST_MAX_ATTEMPTS = 5
+
+class BroadcastEngine:
+    """Job broadcast di background, progress disimpan di tabel broadcast_jobs.
+
+    Kalau bot restart, job 'running' dilanjutkan dari cursor terakhir. User di
+    batch yang belum selesai bisa dapat pesan dua kali (at-least-once). Job yang
+    crash (DB/API error di luar per-user) ditandai 'failed' dan owner dikabari.
+    """
+
+    def __init__(self):
+        self.bucket = TokenBucket(BROADCAST_RATE)
+        self.tasks = {}
+
+    async def start(self, from_chat_id, message_id, admin_chat_id):
+        total = (await database.fetchone("SELECT COUNT(*) FROM users"))[0]
+        progress = await bot.send_message(admin_chat_id, f"📡 **BROADCAST DIMULAI**\nTarget: `{total}` user.")
+        async with database.transaction("broadcast_job_insert") as db:
+            cur = await db.execute(
+                "INSERT INTO broadcast_jobs (from_chat_id, message_id, admin_chat_id, progress_msg_id, total) VALUES (?, ?, ?, ?, ?)",
+                (from_chat_id, message_id, admin_chat_id, progress.message_id, total))
+            job_id = cur.lastrowid
+        self._spawn(job_id)
+        return job_id
+
+    async def resume_all(self):
+        for row in await database.fetchall("SELECT job_id FROM broadcast_jobs WHERE status='running'"):
+            if row[0] not in self.tasks: self._spawn(row[0])
+
+    async def stop(self):
+        for task in list(self.tasks.values()): task.cancel()
+        await asyncio.gather(*self.tasks.values(), return_exceptions=True)
+
+    def _spawn(self, job_id):
+        task = asyncio.create_task(self._run(job_id))
+        self.tasks[job_id] = task
+        task.add_done_callback(lambda _: self.tasks.pop(job_id, None))
+
+    async def _send_one(self, job, user_id):
+        for attempt in range(BROADCAST_MAX_ATTEMPTS):
+            await self.bucket.acquire()
+            try:
+                await bot.copy_message(user_id, job["from_chat_id"], job["message_id"])
+                return "sent"
+            except TelegramRetryAfter as e:
+                # Lolos dari retry OutboundScheduler: semua sender broadcast ikut berhenti
+                self.bucket.pause(e.retry_after)
+            except TelegramForbiddenError:
+                return "blocked"
+            except TelegramBadRequest:
+                return "failed"
+            except (TelegramNetworkError, TelegramServerError):
+                await asyncio.sleep(2 ** attempt)
+            except Exception:
+                return "failed"
+        return "failed"
+
+    async def _report(self, job, counters, started, processed_now, done=False):
+        processed = counters["sent"] + counters["blocked"] + counters["failed"]
+        elapsed = max(time.monotonic() - started, 0.001)
+        speed = processed_now / elapsed
+        if done:
+            head = "✅ **BROADCAST SELESAI**"
+            eta = ""
+        else:
+            head = "📡 **BROADCAST BERJALAN**"
+            remaining = max(job["total"] - processed, 0)
+            eta = f"\nETA: `{int(remaining / speed) if speed else '-'}` detik"
+        text = (f"{head}\n\nProgres: `{processed}` / `{job['total']}`\n"
+                f"✅ Terkirim: `{counters['sent']}`\n🚫 Blokir: `{counters['blocked']}`\n"
+                f"❌ Gagal: `{counters['failed']}`\nKecepatan: `{speed:.1f}` msg/s{eta}")
+        try:
+            await bot.edit_message_text(text, chat_id=job["admin_chat_id"], message_id=job["progress_msg_id"])
+        except Exception:
+            pass
+
+    async def _run(self, job_id):
+        # Antre di belakang balasan interaktif (berlaku untuk task ini & anak-anaknya)
+        api_priority.set(PRIORITY_BACKGROUND)
+        try:
+            await self._process(job_id)
+        except asyncio.CancelledError:
+            raise  # shutdown: status tetap 'running', dilanjut pas start berikutnya
+        except Exception as e:
+            print(f"Broadcast job {job_id} gagal: {e!r}")
+            traceback.print_exception(e)
+            await self._fail(job_id, e)
+
+    async def _fail(self, job_id, error):
+        try:
+            await database.execute(
+                "UPDATE broadcast_jobs SET status='failed' WHERE job_id=? AND status='running'", (job_id,))
+        except Exception as e:
+            print(f"Gagal tandai broadcast job {job_id}: {e!r}")
+        try:
+            await bot.send_message(
+                OWNER_ID, f"❌ **BROADCAST #{job_id} BERHENTI**\nError: `{type(error).__name__}`\n"
+                          "Progress terakhir tersimpan, cek log bot.")
+        except Exception:
+            pass
+
+    async def _process(self, job_id):
+        row = await database.fetchone(
+            "SELECT from_chat_id, message_id, admin_chat_id, progress_msg_id, cursor, total, sent, blocked, failed "
+            "FROM broadcast_jobs WHERE job_id=?", (job_id,))
+        if not row: return
+        keys = ("from_chat_id", "message_id", "admin_chat_id", "progress_msg_id", "cursor", "total")
+        job = dict(zip(keys, row[:6]))
+        counters = {"sent": row[6], "blocked": row[7], "failed": row[8]}
+        cursor = job["cursor"]
+        started = time.monotonic()
+        processed_now = 0
+        last_edit = 0.0
+        sem = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+
+        async def deliver(user_id):
+            async with sem:
+                counters[await self._send_one(job, user_id)] += 1
+
+        while True:
+            rows = await database.fetchall(
+                "SELECT user_id FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?", (cursor, BROADCAST_PAGE))
+            if not rows: break
+            await asyncio.gather(*(deliver(r[0]) for r in rows))
+            cursor = rows[-1][0]
+            processed_now += len(rows)
+            await database.execute(
+                "UPDATE broadcast_jobs SET cursor=?, sent=?, blocked=?, failed=? WHERE job_id=?",
+                (cursor, counters["sent"], counters["blocked"], counters["failed"], job_id))
+            if time.monotonic() - last_edit >= BROADCAST_EDIT_INTERVAL:
+                last_edit = time.monotonic()
+                await self._report(job, counters, started, processed_now)
+
+        await database.execute("UPDATE broadcast_jobs SET status='done' WHERE job_id=?", (job_id,))
+        await self._report(job, counters, started, processed_now, done=True)
+
+broadcast_engine = BroadcastEngine()
+
 @dp.callback_query(F.data == "menu_broadcast", F.from_user.id == OWNER_ID)
 async def broadcast_cb(c: CallbackQuery, state: FSMContext):
     await c.message.answer("Kirim BC:"); await state.set_state(AdminStates.waiting_for_broadcast)
 
 @dp.message(AdminStates.waiting_for_broadcast, F.from_user.id == OWNER_ID)
 async def process_broadcast(m: Message, state: FSMContext):
-    count = 0
-    async with aiosqlite.connect(DB_NAME) as db:
-        async with db.execute("SELECT user_id FROM users") as cur:
-            async for row in cur:
-                try: await m.copy_to(row[0]); count += 1; await asyncio.sleep(0.05)
-                except: pass
-    await m.reply(f"✅ Terkirim ke {count} user."); await state.clear()
+    # State langsung dilepas, broadcast jalan di background
+    await state.clear()
+    await broadcast_engine.start(m.chat.id, m.message_id, m.chat.id)
 
 @dp.message(Command("resetfsub"))
 async def reset_fsub_darurat(m: Message):
     if not await is_admin(m.from_user.id): return
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute("DELETE FROM config WHERE key='fsub_channels'")
-        await db.commit()
+    await database.execute("DELETE FROM config WHERE key='fsub_channels'")
+    config_cache.discard("fsub_channels")
+    notify_peers("config")
     await m.reply("✅ **FSUB DIBERSIHKAN TOTAL!**\nSekarang fsub kosong. Silahkan set ulang lewat /panel dengan bener.")
 
+@dp.message(Command("stats"))
+async def stats_handler(m: Message):
+    if not await is_admin(m.from_user.id): return
+    text = "📈 **RUNTIME STATS**\n"
+    for name, values in collect_stats().items():
+        # nama pakai underscore, jadi taruh di code span biar Markdown ga rusak
+        text += f"\n`{name}`\n"
+        for k, v in values.items():
+            text += f"• `{k}`: `{v}`\n"
+    await m.reply(text)
+
+@dp.message(Command("metrics"))
+async def metrics_handler(m: Message):
+    if not await is_admin(m.from_user.id): return
+    sections = (("⏱ HANDLER", "handler"), ("🗄 DATABASE", "db"), ("📡 BOT API", "api"), ("🧹 JOBS", "job"))
+    text = "📊 **METRICS** (urut total waktu)\n"
+    for title, family in sections:
+        text += f"\n**{title}**\n"
+        rows = metrics.summary(family)
+        if not rows: text += "Belum ada data.\n"
+        for label, count, avg_ms, p99_ms, errors in rows:
+            label = label.replace("`", "'")[:60]
+            text += f"• `{label}`\n   n={count} avg={avg_ms:.1f}ms p99≤{p99_ms:.0f}ms err={errors}\n"
+    await m.reply(text)
+
 @dp.callback_query(F.data == "close_panel")
 async def close_panel(c: CallbackQuery): await c.message.delete()
 
@@ -755,33 +2715,48 @@ async def save_log_group(m: Message, state: FSMContext):
     await state.clear()
 
 # --- FITUR 5: TOP 5 WEEKLY ---
-@dp.callback_query(F.data == "top_weekly")
-@dp.callback_query(F.data == "top_weekly")
-async def top_weekly_handler(c: CallbackQuery):
-    async with aiosqlite.connect(DB_NAME) as db:
-        query = """
-            SELECT COALESCE(m.title, 'Video'), COUNT(v.user_id) as total, m.code
-            FROM views v
-            JOIN media m ON v.media_code = m.code
-            GROUP BY v.media_code
-            ORDER BY total DESC
-            LIMIT 5
-        """
-        async with db.execute(query) as cur:
-            rows = await cur.fetchall()
-
-    if not rows:
-        return await c.answer("📊 Belum ada data. Ayo tonton video dulu!", show_alert=True)
-
-    text = "🏆 **TOP 5 VIDEO REAL-TIME**\n\n"
+TOP_WEEKLY_TTL = int(os.getenv("TOP_WEEKLY_TTL", "60"))  # detik hasil render disimpan
+top_weekly_cache = {"expires": 0.0, "result": None}
+top_weekly_lock = asyncio.Lock()
+
+async def render_top_weekly():
+    # Rolling 7 hari (hari ini + 6 hari sebelumnya) dari tabel rollup harian
+    query = """
+        SELECT COALESCE(m.title, 'Video'), SUM(d.views) as total, m.code
+        FROM media_daily_views d
+        JOIN media m ON d.media_code = m.code
+        WHERE d.day >= date('now', '-6 days')
+        GROUP BY d.media_code
+        ORDER BY total DESC
+        LIMIT 5
+    """
+    rows = await database.fetchall(query)
+    if not rows: return None
+
+    text = "🏆 **TOP 5 VIDEO MINGGU INI**\n\n"
     kb = []
-    bot_user = (await bot.get_me()).username
     for i, row in enumerate(rows, 1):
         text += f"{i}. {row[0]} — ({row[1]} views)\n"
-        kb.append([InlineKeyboardButton(text=f"▶️ NONTON: {row[0]}", url=f"https://t.me/{bot_user}?start={row[2]}")])
+        kb.append([InlineKeyboardButton(text=f"▶️ NONTON: {row[0]}", url=deep_link(row[2]))])
     
     kb.append([InlineKeyboardButton(text="🔙 KEMBALI", callback_data="close_panel")])
-    await c.message.edit_text(text, reply_markup=InlineKeyboardMarkup(inline_keyboard=kb))
+    return text, InlineKeyboardMarkup(inline_keyboard=kb)
+
+@dp.callback_query(F.data == "top_weekly")
+async def top_weekly_handler(c: CallbackQuery):
+    if top_weekly_cache["expires"] < time.monotonic():
+        async with top_weekly_lock:
+            # Cek lagi: yang antre di lock cukup pakai hasil render pertama
+            if top_weekly_cache["expires"] < time.monotonic():
+                top_weekly_cache["result"] = await render_top_weekly()
+                top_weekly_cache["expires"] = time.monotonic() + TOP_WEEKLY_TTL
+    result = top_weekly_cache["result"]
+
+    if not result:
+        return await c.answer("📊 Belum ada data. Ayo tonton video dulu!", show_alert=True)
+
+    text, kb = result
+    await c.message.edit_text(text, reply_markup=kb)
     
 # --- FITUR 10 & 11: REFERRAL SYSTEM ---
 @dp.callback_query(F.data == "menu_ref")
@@ -855,8 +2830,62 @@ async def gen_ref_handler(c: CallbackQuery):
     except Exception as e:
         await c.message.answer(f"❌ Gagal: Pastikan bot Admin di {ref_ch}")
 
+REF_TARGET = 20
+REF_DIGEST_INTERVAL = float(os.getenv("REF_DIGEST_INTERVAL", "60"))  # detik antar digest ke inviter
+
+class ReferralNotifier:
+    """Gabungin notif "Poin Masuk" per inviter jadi satu pesan tiap REF_DIGEST_INTERVAL."""
+
+    def __init__(self):
+        self.pending = {}  # inviter_id -> [jumlah join baru, total terakhir]
+        self.task = None
+        self.sent = 0
+        self.coalesced = 0
+
+    def record(self, inviter_id, total):
+        entry = self.pending.setdefault(inviter_id, [0, total])
+        if entry[0]: self.coalesced += 1
+        entry[0] += 1
+        entry[1] = total
+
+    def discard(self, inviter_id):
+        self.pending.pop(inviter_id, None)
+
+    async def flush(self):
+        batch, self.pending = self.pending, {}
+        for inviter_id, (joins, total) in batch.items():
+            who = "Seseorang" if joins == 1 else f"`{joins}` orang"
+            try:
+                await bot.send_message(inviter_id, f"🔔 **Poin Masuk!**\n{who} join via link kamu.\nTotal: `{total}` / {REF_TARGET}")
+                self.sent += 1
+            except Exception:
+                pass
+
+    async def _run(self):
+        api_priority.set(PRIORITY_BACKGROUND)
+        while True:
+            await asyncio.sleep(REF_DIGEST_INTERVAL)
+            await self.flush()
+
+    def start(self):
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        await self.flush()
+
+    def stats(self):
+        return {"pending_inviters": len(self.pending), "digests_sent": self.sent, "coalesced": self.coalesced}
+
+referral_notifier = ReferralNotifier()
+register_stats("referral_notifier", referral_notifier.stats)
+
 @dp.chat_member()
 async def tracking_public_join(event: ChatMemberUpdated):
+    fsub_cache.observe(event)
     # Tahap 3: Notifikasi Pribadi setiap ada yang join
     if event.new_chat_member.status == "member":
         invite_link = event.invite_link
@@ -865,31 +2894,33 @@ async def tracking_public_join(event: ChatMemberUpdated):
                 inviter_id = int(invite_link.name.split("_")[1])
                 new_user_id = event.from_user.id
                 if inviter_id == new_user_id: return
-
-                async with aiosqlite.connect(DB_NAME) as db:
-                    # Anti-cheat: satu user diajak cuma dihitung sekali
-                    res = await db.execute("SELECT 1 FROM referrals WHERE invited_user=?", (new_user_id,))
-                    if await res.fetchone(): return
-
-                    await db.execute("INSERT INTO referrals (owner_id, invited_user) VALUES (?, ?)", (inviter_id, new_user_id))
-                    async with db.execute("SELECT COUNT(*) FROM referrals WHERE owner_id=?", (inviter_id,)) as cur:
-                        count = (await cur.fetchone())[0]
-                    await db.commit()
+                # Mode workers: update ini juga dikirim ke worker si inviter, poin & digest diurus di sana
+                if not owns_user(inviter_id): return
+
+                async with database.transaction("referral_join") as db:
+                    # Anti-cheat: satu user diajak cuma dihitung sekali (invited_user PRIMARY KEY)
+                    res = await db.execute("INSERT OR IGNORE INTO referrals (owner_id, invited_user) VALUES (?, ?)", (inviter_id, new_user_id))
+                    if res.rowcount == 0: return
+
+                    async with db.execute(
+                        "INSERT INTO referral_counts (owner_id, total) VALUES (?, 1) "
+                        "ON CONFLICT (owner_id) DO UPDATE SET total = total + 1 RETURNING total", (inviter_id,)) as cur:
+                        count = (await cur.fetchall())[0][0]
                 
-                # Kasih tau secara pribadi
-                if count == 20:
+                # Kasih tau secara pribadi: milestone langsung, sisanya digabung jadi digest
+                if count == REF_TARGET:
+                    referral_notifier.discard(inviter_id)
                     text_win = "🎊 **SELAMAT!** Kamu berhasil mengajak 20 orang!\n\nKlik tombol di bawah untuk klaim hadiah VIP kamu."
                     kb_win = [[InlineKeyboardButton(text="🎁 KLAIM HADIAH VIP", callback_data="klaim_ref_reward")]]
                     await bot.send_message(inviter_id, text_win, reply_markup=InlineKeyboardMarkup(inline_keyboard=kb_win))
                 else:
-                    await bot.send_message(inviter_id, f"🔔 **Poin Masuk!**\nSeseorang join via link kamu.\nTotal: `{count}` / 20")
+                    referral_notifier.record(inviter_id, count)
             except: pass
 
 @dp.callback_query(F.data == "status_ref")
 async def status_ref(c: CallbackQuery):
-    async with aiosqlite.connect(DB_NAME) as db:
-        async with db.execute("SELECT COUNT(*) FROM referrals WHERE owner_id=?", (c.from_user.id,)) as cur:
-            count = (await cur.fetchone())[0]
+    row = await database.fetchone("SELECT total FROM referral_counts WHERE owner_id=?", (c.from_user.id,))
+    count = row[0] if row else 0
             
     text = f"📊 **STATUS REFERRAL**\n\nProgres: `{count}` / 20 orang."
     kb = []
@@ -900,22 +2931,36 @@ async def status_ref(c: CallbackQuery):
 
 @dp.callback_query(F.data == "klaim_ref_reward")
 async def process_klaim_ref(c: CallbackQuery):
+    uid = c.from_user.id
+    status = invoice_id = None
+    # Cek klaim, potong poin & bikin invoice dalam satu transaksi: klik dobel / callback
+    # lama ga bisa bikin dua klaim dari 20 poin yang sama
+    async with database.transaction("referral_claim") as db:
+        async with db.execute(
+                "SELECT status FROM payments WHERE user_id=? AND kind='referral' "
+                "AND status IN ('pending', 'approved') LIMIT 1", (uid,)) as cur:
+            row = await cur.fetchone()
+        if row:
+            status = INVOICE_STATUS_LABEL.get(row[0], row[0])
+        else:
+            cur = await db.execute(
+                "UPDATE referral_counts SET total = total - ? WHERE owner_id=? AND total >= ?",
+                (REF_TARGET, uid, REF_TARGET))
+            if cur.rowcount == 1:
+                # Satu siklus klaim = satu invoice_id (ref-{uid}-{n}), naik tiap klaim baru
+                async with db.execute("SELECT COUNT(*) FROM payments WHERE user_id=? AND kind='referral'", (uid,)) as cur:
+                    invoice_id = f"ref-{uid}-{(await cur.fetchone())[0] + 1}"
+                await db.execute(INVOICE_INSERT, (invoice_id, uid, c.from_user.full_name, "referral", None))
+    # Klaim yang masih jalan: klik ulang cuma lihat statusnya
+    if status:
+        return await c.answer(f"Klaim kamu sudah tercatat. Status: {status}", show_alert=True)
+    if not invoice_id:
+        return await c.answer(f"Poin kamu belum cukup ({REF_TARGET} orang).", show_alert=True)
+    inv = await get_invoice(invoice_id)
+
     # Tahap 4: Forward ke Admin untuk Approve
-    kb_admin = InlineKeyboardMarkup(inline_keyboard=[
-        [
-            InlineKeyboardButton(text="✅ APPROVE (Kirim Link VIP)", callback_data=f"vip_action:approve:{c.from_user.id}"),
-            InlineKeyboardButton(text="❌ TOLAK", callback_data=f"reply:{c.from_user.id}")
-        ]
-    ])
-    
-    await bot.send_message(
-        OWNER_ID, 
-        f"📩 **KLAIM REFERRAL BARU**\n\n"
-        f"User: `{c.from_user.id}`\n"
-        f"Nama: {c.from_user.full_name}\n"
-        f"Poin: 20 (Sistem Terverifikasi)",
-        reply_markup=kb_admin
-    )
+    text, kb_admin = invoice_view(inv)
+    await bot.send_message(OWNER_ID, text + f"\nPoin: {REF_TARGET} (Sistem Terverifikasi)", reply_markup=kb_admin)
     await c.message.edit_text("✅ **PERMINTAAN KLAIM TERKIRIM!**\nAdmin akan segera memberikan link VIP kamu. Mohon tunggu.")
 
 # --- SET CHANNEL REFERRAL (ADMIN ONLY) ---
@@ -930,13 +2975,322 @@ async def save_ref_ch(m: Message, state: FSMContext):
     await m.reply(f"✅ Channel Referral Set ke: {m.text}")
     await state.clear()
     
-async def main():
-    await init_db() 
-    await init_payment_table()
+# WAJIB: allowed_updates agar bot bisa dapet info member join
+ALLOWED_UPDATES = ["message", "callback_query", "chat_member", "chat_join_request"]
+
+async def init_schema():
+    await migrate()
+    await check_auto_vacuum()
+    await check_query_plans()
+
+async def reload_state():
+    """Muat ulang semua cache dari DB (startup, /update, atau DB diganti worker lain)."""
+    await fsm_storage.load_keys()
+    fsm_storage.dirty |= set(fsm_storage.hot)  # sesi yang lagi jalan ikut ditulis ke DB baru
+    await config_cache.load()
+    await admin_roster.load()
+    await known_users.load()
+    media_cache.clear()
+    top_weekly_cache["expires"] = 0.0
+
+async def startup(migrate=True, jobs=True):
+    await database.open()
+    if migrate: await init_schema()  # mode workers: skema sudah disiapkan coordinator
+    await reload_state()
+    await load_bot_identity()
+    view_buffer.start()
+    referral_notifier.start()
+    fsm_storage.start()
+    if jobs:  # mode workers: cuma worker 0
+        maintenance.start()
+        invite_pool.start()
+    if METRICS_PORT: await start_metrics_server()
+
+async def shutdown():
+    maintenance.stop()
+    await invite_pool.stop()
+    await update_executor.wait_idle()
+    await stop_metrics_server()
+    await broadcast_engine.stop()
+    await view_buffer.stop()
+    await referral_notifier.stop()
+    await fsm_storage.close()
+    await database.close()
+
+async def run_polling():
     await bot.delete_webhook(drop_pending_updates=True)
-    
-    # WAJIB: Tambahkan allowed_updates agar bot bisa dapet info member join
-    await dp.start_polling(bot, allowed_updates=["message", "callback_query", "chat_member", "chat_join_request"])
+    await broadcast_engine.resume_all()
+    # Executor yang bikin task per user; polling cukup nunggu update diantrekan (backpressure)
+    await dp.start_polling(bot, allowed_updates=ALLOWED_UPDATES, handle_as_tasks=not update_executor.enabled)
+
+async def run_webhook():
+    """Terima update lewat aiohttp. Update di-ack 200 begitu masuk antrean executor
+    (atau diproses di background kalau UPDATE_WORKERS=0).
+
+    Tes lokal (WEBHOOK_BASE_URL kosong, jadi set_webhook di-skip):
+        curl -X POST localhost:8080/webhook -H "Content-Type: application/json" \\
+             -H "X-Telegram-Bot-Api-Secret-Token: $WEBHOOK_SECRET" -d @update.json
+    (WEBHOOK_SECRET kosong = pakai secret acak yang dicetak pas start.)
+    """
+    secret = WEBHOOK_SECRET
+    if not secret:
+        # Endpoint tanpa secret = siapa aja yang bisa akses port-nya bisa kirim update palsu
+        # atas nama OWNER_ID (/update, /broadcast, ...). Jadi selalu ada secret: kalau ga
+        # diset, bikin acak per sesi; Telegram dapat lewat set_webhook di bawah.
+        secret = secrets.token_urlsafe(32)
+        if WEBHOOK_BASE_URL:
+            print("⚠️ WEBHOOK_SECRET kosong, pakai secret acak untuk sesi ini")
+        else:
+            print(f"⚠️ WEBHOOK_SECRET kosong, secret sesi ini: {secret}")
+    app = web.Application()
+    SimpleRequestHandler(
+        dispatcher=dp, bot=bot, secret_token=secret,
+        handle_in_background=not update_executor.enabled
+    ).register(app, path=WEBHOOK_PATH)
+    # /metrics sengaja ga di sini (app ini publik); pakai METRICS_PORT di METRICS_HOST
+    setup_application(app, dp, bot=bot)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+        if WEBHOOK_BASE_URL:
+            await bot.set_webhook(WEBHOOK_BASE_URL.rstrip("/") + WEBHOOK_PATH, secret_token=secret,
+                                  allowed_updates=ALLOWED_UPDATES, drop_pending_updates=True)
+        await broadcast_engine.resume_all()
+        print(f"Webhook jalan di {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+# ================= WORKER MODE =================
+WORKER_QUEUE_MAX = int(os.getenv("WORKER_QUEUE_MAX", "100"))          # batch update yang boleh antre per worker
+WORKER_RESTART_DELAY = float(os.getenv("WORKER_RESTART_DELAY", "2"))  # interval cek worker mati
+WORKER_STOP_TIMEOUT = float(os.getenv("WORKER_STOP_TIMEOUT", "30"))   # nunggu worker beres sebelum di-kill
+POLL_TIMEOUT = 30
+
+worker_index = None  # diisi di proses worker
+worker_count = 1
+peer_events = None   # queue worker -> coordinator buat relay invalidasi cache
+
+def owns_user(user_id):
+    """True kalau update user ini di-shard ke worker ini (selalu True di luar mode workers)."""
+    return worker_index is None or user_id % worker_count == worker_index
+
+def notify_peers(name):
+    """Kabari worker lain kalau cache `name` berubah. Di luar mode workers ga ngapa-ngapain."""
+    if peer_events is not None:
+        peer_events.put((worker_index, name))
+
+# "reload" = worker lain habis restore DB (/update); koneksi tetap, cache dimuat ulang
+PEER_RELOADERS = {"config": config_cache.load, "reload": reload_state,
+                  "invite_pool": invite_pool.kick}
+
+def shard_of(raw, workers):
+    """Worker tujuan update mentah. Kuncinya sama kayak UpdateExecutor (user, fallback chat),
+    jadi semua update satu user selalu ke worker yang sama dan urutan FSM-nya kejaga."""
+    for field, obj in raw.items():
+        if field != "update_id" and isinstance(obj, dict):
+            owner = obj.get("from") or obj.get("chat") or (obj.get("message") or {}).get("chat") or {}
+            return owner.get("id", 0) % workers
+    return 0
+
+def referral_inviter(raw):
+    """ID inviter kalau update-nya chat_member lewat link REF_{id}, selain itu None."""
+    name = ((raw.get("chat_member") or {}).get("invite_link") or {}).get("name") or ""
+    return int(name[4:]) if name.startswith("REF_") and name[4:].isdigit() else None
+
+def queue_get(q, timeout=1.0):
+    """get() dengan timeout biar thread to_thread ga nyangkut selamanya pas shutdown."""
+    try:
+        return q.get(timeout=timeout)
+    except queue.Empty:
+        return None
+
+def worker_main(index, size, inbox, events, resume):
+    """Entry proses worker (spawn). Ctrl+C diabaikan, stop lewat sentinel dari coordinator."""
+    global worker_index, worker_count, peer_events, METRICS_PORT
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    worker_index, worker_count, peer_events = index, size, events
+    # Limit global Telegram itu per bot, bukan per proses: tiap worker dapat jatah rata
+    outbound.global_bucket = TokenBucket(API_GLOBAL_RATE / size)
+    if METRICS_PORT: METRICS_PORT += index  # tiap worker punya /metrics sendiri
+    register_stats("worker", lambda: {"index": index, "pid": os.getpid()})
+    asyncio.run(worker_loop(inbox, resume))
+
+async def worker_loop(inbox, resume):
+    await startup(migrate=False, jobs=worker_index == 0)
+    if resume: await broadcast_engine.resume_all()
+    try:
+        while True:
+            msg = await asyncio.to_thread(queue_get, inbox)
+            if msg is None:
+                if multiprocessing.parent_process().is_alive(): continue
+                break  # coordinator mati mendadak
+            kind, payload = msg
+            if kind == "stop": break
+            if kind == "peer":
+                try:
+                    await PEER_RELOADERS[payload]()
+                except Exception as e:
+                    print(f"[worker {worker_index}] Gagal reload {payload}: {e!r}")
+                continue
+            for raw in payload:
+                try:
+                    await dp.feed_raw_update(bot, raw)
+                except Exception as e:
+                    # Mode inline (UPDATE_WORKERS=0): errornya sudah lewat observer `errors` dispatcher
+                    print(f"[worker {worker_index}] Error update {raw.get('update_id')}: {e!r}")
+                    traceback.print_exception(e)
+    finally:
+        await shutdown()
+        await bot.session.close()
+
+class WorkerPool:
+    """Coordinator mode workers: satu-satunya proses yang getUpdates. Update mentah (dict JSON,
+    ga di-parse ke model) dibagi per user ke N proses yang masing-masing jalanin `dp` sendiri
+    dengan koneksi DB dan cache sendiri. Worker mati di-restart; invalidasi cache di-relay.
+
+    Worker yang di-restart ga melanjutkan broadcast yang lagi jalan di dia; job itu
+    dilanjutkan worker 0 pas bot start ulang berikutnya.
+
+    API_GLOBAL_RATE dibagi rata ke semua worker (tanpa koordinasi antar proses), jadi
+    total tetap di bawah limit Telegram; broadcast di satu worker ikut kebatas jatahnya.
+    Limit per chat cuma penuh buat chat private user shard sendiri; group/channel (log,
+    fsub), OWNER_ID dan user shard lain bisa dikirimi semua worker, jadi jatahnya juga
+    dibagi rata. Join referral diproses di shard inviter biar notifnya ga kepecah.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.ctx = multiprocessing.get_context("spawn")  # fork + event loop/aiohttp yang jalan = rawan
+        self.events = self.ctx.Queue()
+        self.inboxes = [None] * size
+        self.procs = [None] * size
+        self.dispatched = [0] * size
+        self.restarts = 0
+        self.stopping = asyncio.Event()
+
+    def _spawn(self, index, resume=False):
+        # Queue baru tiap spawn: proses yang mati bisa ninggalin lock queue lama kepegang
+        self.inboxes[index] = self.ctx.Queue(WORKER_QUEUE_MAX)
+        proc = self.ctx.Process(target=worker_main, name=f"bot-worker-{index}",
+                                args=(index, self.size, self.inboxes[index], self.events, resume))
+        proc.start()
+        self.procs[index] = proc
+
+    async def _put(self, index, msg):
+        # Queue penuh = worker ketinggalan; polling ikut nunggu (backpressure)
+        while True:
+            try:
+                return await asyncio.to_thread(self.inboxes[index].put, msg, True, 1.0)
+            except queue.Full:
+                continue
+
+    async def _supervise(self):
+        while True:
+            await asyncio.sleep(WORKER_RESTART_DELAY)
+            for i, proc in enumerate(self.procs):
+                if not proc.is_alive():
+                    print(f"⚠️ Worker {i} mati (exit code {proc.exitcode}), restart...")
+                    self.restarts += 1
+                    self._spawn(i)
+
+    async def _relay(self):
+        while True:
+            event = await asyncio.to_thread(queue_get, self.events)
+            if event is None: continue
+            sender, name = event
+            for i in range(self.size):
+                if i != sender: await self._put(i, ("peer", name))
+
+    async def _poll(self):
+        url = bot.session.api.api_url(BOT_TOKEN, "getUpdates")
+        offset = 0
+        async with ClientSession(timeout=ClientTimeout(total=POLL_TIMEOUT + 10)) as http:
+            while True:
+                try:
+                    async with http.post(url, json={"offset": offset, "timeout": POLL_TIMEOUT,
+                                                    "allowed_updates": ALLOWED_UPDATES}) as resp:
+                        body = await resp.json()
+                except (ClientError, asyncio.TimeoutError) as e:
+                    print(f"getUpdates error: {e!r}")
+                    await asyncio.sleep(1)
+                    continue
+                if not body.get("ok"):
+                    print(f"getUpdates gagal: {body.get('description')}")
+                    await asyncio.sleep((body.get("parameters") or {}).get("retry_after", 1))
+                    continue
+                batches = {}
+                for raw in body["result"]:
+                    offset = raw["update_id"] + 1
+                    shard = shard_of(raw, self.size)
+                    batches.setdefault(shard, []).append(raw)
+                    # Join referral: fsub cache si joiner di-update di shard-nya, poin & notif
+                    # inviter di shard inviter (biar digest ReferralNotifier ga kepecah)
+                    inviter = referral_inviter(raw)
+                    if inviter is not None and inviter % self.size != shard:
+                        batches.setdefault(inviter % self.size, []).append(raw)
+                for i, batch in batches.items():
+                    await self._put(i, ("updates", batch))
+                    self.dispatched[i] += len(batch)
+
+    async def stop(self):
+        for i, proc in enumerate(self.procs):
+            if proc and proc.is_alive():
+                try:
+                    await asyncio.to_thread(self.inboxes[i].put, ("stop", None), True, WORKER_STOP_TIMEOUT)
+                except queue.Full:
+                    pass
+        for proc in self.procs:
+            if not proc: continue
+            await asyncio.to_thread(proc.join, WORKER_STOP_TIMEOUT)
+            if proc.is_alive():
+                print(f"⚠️ {proc.name} ga berhenti, di-terminate")
+                proc.terminate()
+
+    async def run(self):
+        await bot.delete_webhook(drop_pending_updates=True)
+        for i in range(self.size):
+            self._spawn(i, resume=(i == 0))
+        tasks = [asyncio.create_task(c) for c in (self._supervise(), self._relay(), self._poll())]
+        stopper = asyncio.create_task(self.stopping.wait())
+        try:
+            done, _ = await asyncio.wait([*tasks, stopper], return_when=asyncio.FIRST_COMPLETED)
+            for t in done - {stopper}: t.result()  # task coordinator crash = error beneran
+        finally:
+            stopper.cancel()
+            for t in tasks: t.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await self.stop()
+            print(f"Worker pool berhenti. Update per worker: {self.dispatched}, restart: {self.restarts}")
+
+async def run_workers():
+    # Migrasi skema sekali di sini, bukan barengan di N worker
+    await database.open()
+    try:
+        await init_schema()
+    finally:
+        await database.close()
+    pool = WorkerPool(max(WORKERS, 1))
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        asyncio.get_running_loop().add_signal_handler(sig, pool.stopping.set)
+    try:
+        await pool.run()
+    finally:
+        await bot.session.close()
+
+async def main():
+    if BOT_MODE == "workers":
+        return await run_workers()
+    await startup()
+    try:
+        if BOT_MODE == "webhook":
+            await run_webhook()
+        else:
+            await run_polling()
+    finally:
+        await shutdown()
 if __name__ == "__main__":
     asyncio.run(main())
 